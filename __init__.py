@@ -5,6 +5,9 @@ from trytond.pool import Pool
 from . import caldav
 from .todo import *
 from .webdav import *
+from .calendar_ import *
+from .user import *
+from .propagation import *
 
 
 def register():
@@ -17,5 +20,11 @@ def register():
         TodoExRule,
         TodoAttendee,
         TodoAlarm,
+        TodoTombstone,
+        TodoPropagation,
         Collection,
+        Calendar,
+        CalendarReadUser,
+        CalendarWriteUser,
+        User,
         module='calendar_todo', type_='model')
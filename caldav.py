@@ -1,8 +1,28 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from pywebdav.lib import propfind
-from pywebdav.lib.utils import get_uriparentpath
-from trytond.modules.webdav.protocol import TrytonDAVInterface
+import zlib
+import urllib
+from itertools import chain
+import urlparse
+import xml.dom.minidom
+from xml.parsers.expat import ExpatError
+
+from pywebdav.lib import propfind, report
+from pywebdav.lib.WebDAVServer import DAVRequestHandler
+from pywebdav.lib.constants import RT_PROPNAME, RT_PROP
+from pywebdav.lib.errors import DAV_Error, DAV_NotFound, DAV_Secret, \
+    DAV_Forbidden
+from pywebdav.lib.utils import get_uriparentpath, get_parenturi, \
+    rfc1123_date
+from trytond.modules.webdav.protocol import TrytonDAVInterface, LOCAL
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+
+domimpl = xml.dom.minidom.getDOMImplementation()
+# The chunks of the multistatus produced before its status: the XML
+# declaration, the multistatus tag and the responses of the uri and of its
+# first child which reads the first batch of childs
+MULTISTATUS_PRIMED = 4
 
 _mk_prop_response = propfind.PROPFIND.mk_prop_response
 
@@ -23,3 +43,304 @@ def mk_prop_response(self, uri, good_props, bad_props, doc):
     return res
 
 propfind.PROPFIND.mk_prop_response = mk_prop_response
+
+
+def iter_childs(self, uri, filter=None):
+    'Yield the childs of the uri like get_childs but lazily'
+    dbname, dburi = self._get_dburi(uri)
+    if not dbname:
+        for child in self.get_childs(uri, filter=filter):
+            yield child
+        return
+    pool = Pool(Transaction().database.name)
+    try:
+        Collection = pool.get('webdav.collection')
+        scheme, netloc, path, params, query, fragment = \
+            urlparse.urlparse(uri)
+        if path[-1:] != '/':
+            path += '/'
+        for child in Collection.iter_childs(dburi, filter=filter,
+                cache=LOCAL.cache):
+            yield urlparse.urlunparse((scheme, netloc,
+                    path + child.encode('utf-8'), params, query, fragment))
+    except KeyError:
+        return
+    except (DAV_Error, DAV_NotFound, DAV_Secret, DAV_Forbidden), exception:
+        self._log_exception(exception)
+        raise
+    except Exception, exception:
+        self._log_exception(exception)
+        raise DAV_Error(500)
+
+TrytonDAVInterface.iter_childs = iter_childs
+
+
+def _propfind_uris(self):
+    'Yield the uris of the PROPFIND request according to its depth'
+    yield self._uri
+    if self._depth == '0':
+        return
+    if self._depth == '1':
+        for uri in self._dataclass.iter_childs(self._uri):
+            yield uri
+        return
+    uris = [self._uri]
+    while uris:
+        for uri in self._dataclass.iter_childs(uris.pop()):
+            yield uri
+            uris.append(uri)
+
+propfind.PROPFIND._iter_uris = _propfind_uris
+
+
+def _report_uris(self):
+    'Yield the uris of the REPORT request matching its filter'
+    dc = self._dataclass
+    if self._depth == 'infinity':
+        uris = [self._uri]
+        while uris:
+            uri = uris.pop()
+            if uri in dc.get_childs(get_parenturi(uri), self.filter):
+                yield uri
+            uris.extend(dc.get_childs(uri) or [])
+        return
+    if self._depth not in ('0', '1'):
+        return
+    if self._uri in dc.get_childs(get_parenturi(self._uri), self.filter):
+        yield self._uri
+    if self._depth == '1':
+        for uri in dc.iter_childs(self._uri, self.filter):
+            yield uri
+
+report.REPORT._iter_uris = _report_uris
+
+
+def iter_prop(self):
+    '''
+    Yield the multistatus of the properties by serializing each response
+    once built instead of the whole document
+    '''
+    doc = domimpl.createDocument(None, 'multistatus', None)
+    yield '<?xml version="1.0" encoding="utf-8"?>'
+    yield '<D:multistatus xmlns:D="DAV:">'
+    for uri in self._iter_uris():
+        good_props, bad_props = self.get_propvalues(uri)
+        response = self.mk_prop_response(uri, good_props, bad_props, doc)
+        yield response.toxml(encoding='utf-8')
+        response.unlink()
+    yield '</D:multistatus>\n'
+
+propfind.PROPFIND.iter_prop = iter_prop
+
+
+def create_prop(self):
+    return ''.join(self.iter_prop())
+
+propfind.PROPFIND.create_prop = create_prop
+report.REPORT.create_prop = create_prop
+
+
+def iter_response(self):
+    '''
+    Return an iterator over the chunks of the multistatus response like
+    createResponse
+    '''
+    dc = self._dataclass
+    if not dc.exists(self._uri):
+        raise DAV_NotFound
+    if self.request_type == RT_PROPNAME:
+        return iter([self.create_propname()])
+    if self.request_type != RT_PROP:
+        # No body means ALLPROP
+        self.proplist = {}
+        self.namespaces = []
+        for ns, plist in dc.get_propnames(self._uri).items():
+            self.proplist[ns] = plist
+            self.namespaces.append(ns)
+    return self.iter_prop()
+
+propfind.PROPFIND.iter_response = iter_response
+
+
+def _gzip(chunks):
+    'Compress the chunks in the gzip format'
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def _send_multistatus(handler, request, chunk_filter=None):
+    '''
+    Send each chunk of the multistatus response of the request once
+    produced using the chunked transfer coding or, with HTTP/1.0, until the
+    connection is closed.
+    The chunks up to the first child are produced before the status so the
+    errors of the request and of the first batch of childs are sent as
+    their status. A later error stops the body without its last chunk and
+    closes the connection so the response is seen as incomplete.
+    '''
+    chunks = []
+    try:
+        iterator = request.iter_response()
+        for chunk in iterator:
+            chunks.append(chunk)
+            if len(chunks) >= MULTISTATUS_PRIMED:
+                break
+    except DAV_Error, (code, _):
+        return handler.send_status(code)
+    except Exception, exception:
+        handler.IFACE_CLASS._log_exception(exception)
+        return handler.send_status(500)
+    chunks = chain(chunks, iterator)
+    if chunk_filter:
+        chunks = (chunk_filter(c) for c in chunks)
+    chunked = (handler.protocol_version >= 'HTTP/1.1'
+        and handler.request_version >= 'HTTP/1.1')
+
+    handler.send_response(207, 'Multi-Status')
+    handler.send_header('Content-Type', 'text/xml; charset="utf-8"')
+    handler.send_header('Date', rfc1123_date())
+    handler._send_dav_version()
+    if chunked:
+        handler.send_header('Transfer-Encoding', 'chunked')
+    else:
+        handler.send_header('Connection', 'close')
+        handler.close_connection = 1
+    if 'gzip' in [e.strip()
+            for e in handler.headers.get('Accept-Encoding', '').split(',')]:
+        handler.send_header('Content-Encoding', 'gzip')
+        chunks = _gzip(chunks)
+    handler.end_headers()
+
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if chunked:
+                handler.wfile.write('%x\r\n' % len(chunk))
+                handler.wfile.write(chunk)
+                handler.wfile.write('\r\n')
+            else:
+                handler.wfile.write(chunk)
+    except Exception, exception:
+        if not isinstance(exception, DAV_Error):
+            handler.IFACE_CLASS._log_exception(exception)
+        handler.close_connection = 1
+        return
+    if chunked:
+        handler.wfile.write('0\r\n\r\n')
+
+
+def _read_request(handler, depth):
+    'Return the uri, the depth and the body of the request'
+    body = None
+    if 'Content-Length' in handler.headers:
+        body = handler.rfile.read(int(handler.headers['Content-Length']))
+    uri = urllib.unquote(urlparse.urljoin(
+            handler.get_baseuri(handler.IFACE_CLASS), handler.path))
+    return uri, handler.headers.get('Depth', depth), body
+
+
+def _msie_dates(chunk):
+    'Work around the MSIE DAV bug for the creation and modification dates'
+    chunk = chunk.replace('<ns0:getlastmodified xmlns:ns0="DAV:">',
+        '<ns0:getlastmodified xmlns:n="DAV:" '
+        'xmlns:b="urn:uuid:c2f41010-65b3-11d1-a29f-00aa00c14882/" '
+        'b:dt="dateTime.rfc1123">')
+    return chunk.replace('<ns0:creationdate xmlns:ns0="DAV:">',
+        '<ns0:creationdate xmlns:n="DAV:" '
+        'xmlns:b="urn:uuid:c2f41010-65b3-11d1-a29f-00aa00c14882/" '
+        'b:dt="dateTime.tz">')
+
+
+def do_PROPFIND(self):
+    uri, depth, body = _read_request(self, 'infinity')
+    try:
+        request = propfind.PROPFIND(uri, self.IFACE_CLASS, depth, body)
+    except ExpatError:
+        return self.send_status(400)
+    chunk_filter = None
+    if (self.headers.get('User-Agent')
+            == 'Microsoft Data Access Internet Publishing Provider DAV 1.1'):
+        chunk_filter = _msie_dates
+    _send_multistatus(self, request, chunk_filter)
+
+DAVRequestHandler.do_PROPFIND = do_PROPFIND
+
+
+def do_REPORT(self):
+    uri, depth, body = _read_request(self, '0')
+    request = report.REPORT(uri, self.IFACE_CLASS, depth, body)
+    _send_multistatus(self, request)
+
+DAVRequestHandler.do_REPORT = do_REPORT
+
+_get_dav_getetag = TrytonDAVInterface._get_dav_getetag
+
+
+def get_dav_getetag(self, uri):
+    dbname, dburi = TrytonDAVInterface.get_dburi(uri)
+    database = Transaction().database
+    if dbname and database and database.name == dbname:
+        Collection = Pool().get('webdav.collection')
+        etag = Collection.get_etag(dburi)
+        if etag:
+            return etag
+    return _get_dav_getetag(self, uri)
+
+TrytonDAVInterface._get_dav_getetag = get_dav_getetag
+
+
+def _get_etag(handler):
+    'Return the entity tag of the requested resource or None'
+    dc = handler.IFACE_CLASS
+    uri = urllib.unquote(urlparse.urljoin(handler.get_baseuri(dc),
+            handler.path))
+    try:
+        return dc.get_prop(uri, 'DAV:', 'getetag')
+    except Exception:
+        return None
+
+
+def _match_etag(header, etag):
+    'Test if the etag matches the If-Match or If-None-Match header'
+    return any(t.strip() in ('*', etag) for t in header.split(','))
+
+
+def _send_precondition(handler, code, etag=None):
+    handler.send_response(code)
+    if etag:
+        handler.send_header('ETag', etag)
+    handler.send_header('Content-Length', '0')
+    handler.end_headers()
+
+_do_GET = DAVRequestHandler.do_GET
+
+
+def do_GET(self):
+    if_none_match = self.headers.get('If-None-Match')
+    if if_none_match:
+        etag = _get_etag(self)
+        if etag and _match_etag(if_none_match, etag):
+            _send_precondition(self, 304, etag)
+            return
+    return _do_GET(self)
+
+DAVRequestHandler.do_GET = do_GET
+
+_do_PUT = DAVRequestHandler.do_PUT
+
+
+def do_PUT(self):
+    if_match = self.headers.get('If-Match')
+    if if_match:
+        etag = _get_etag(self)
+        if not etag or not _match_etag(if_match, etag):
+            # The body is not read
+            self.close_connection = 1
+            _send_precondition(self, 412)
+            return
+    return _do_PUT(self)
+
+DAVRequestHandler.do_PUT = do_PUT
@@ -0,0 +1,63 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Calendar', 'CalendarReadUser', 'CalendarWriteUser']
+
+
+class Calendar:
+    __metaclass__ = PoolMeta
+    __name__ = 'calendar.calendar'
+
+    @classmethod
+    def create(cls, vlist):
+        User = Pool().get('res.user')
+        calendars = super(Calendar, cls).create(vlist)
+        User._todo_calendars_clear()
+        return calendars
+
+    @classmethod
+    def write(cls, *args):
+        User = Pool().get('res.user')
+        super(Calendar, cls).write(*args)
+        if any('owner' in v for v in args[1::2]):
+            User._todo_calendars_clear()
+
+    @classmethod
+    def delete(cls, calendars):
+        User = Pool().get('res.user')
+        super(Calendar, cls).delete(calendars)
+        User._todo_calendars_clear()
+
+
+class SharingMixin(object):
+    'Clear the calendars of the users when the sharing changes'
+
+    @classmethod
+    def create(cls, vlist):
+        User = Pool().get('res.user')
+        records = super(SharingMixin, cls).create(vlist)
+        User._todo_calendars_clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        User = Pool().get('res.user')
+        super(SharingMixin, cls).write(*args)
+        User._todo_calendars_clear()
+
+    @classmethod
+    def delete(cls, records):
+        User = Pool().get('res.user')
+        super(SharingMixin, cls).delete(records)
+        User._todo_calendars_clear()
+
+
+class CalendarReadUser(SharingMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'calendar.calendar-read-res.user'
+
+
+class CalendarWriteUser(SharingMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'calendar.calendar-write-res.user'
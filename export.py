@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Export the todos with their categories and attendees as JSON lines
+
+The todos are read by batches with a server-side cursor on PostgreSQL so the
+memory used does not depend on the number of todos. The --since option
+exports only the todos created or modified since a date and the date to use
+for the next export is logged:
+
+    python -m trytond.modules.calendar_todo.export -c trytond.conf \
+-d database --since 2017-01-01T00:00:00 -o todos.jsonl
+'''
+import sys
+import json
+import logging
+import argparse
+import datetime
+
+from sql.conditionals import Coalesce
+
+from trytond import backend
+from trytond.tools import reduce_ids
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+
+__all__ = ['export_todos']
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ['id', 'calendar', 'parent', 'uuid', 'recurrence', 'summary',
+    'description', 'status', 'percent_complete', 'classification',
+    'dtstart', 'due', 'completed', 'organizer', 'active', 'create_date',
+    'write_date']
+
+
+def _cursor(batch):
+    'Return a cursor fetching the rows by batch on the server side'
+    connection = Transaction().connection
+    if backend.name() == 'postgresql':
+        cursor = connection.cursor('calendar_todo_export')
+        cursor.itersize = batch
+        return cursor
+    return connection.cursor()
+
+
+def export_todos(since=None, batch=1000):
+    '''
+    Yield a dictionary for each todo modified since the date ordered by
+    modification date with the names of its categories and location and
+    the email and status of its attendees
+    '''
+    pool = Pool()
+    Todo = pool.get('calendar.todo')
+    TodoCategory = pool.get('calendar.todo-calendar.category')
+    Category = pool.get('calendar.category')
+    Location = pool.get('calendar.location')
+    Attendee = pool.get('calendar.todo.attendee')
+    todo = Todo.__table__()
+    todo_category = TodoCategory.__table__()
+    category = Category.__table__()
+    location = Location.__table__()
+    attendee = Attendee.__table__()
+
+    timestamp = Coalesce(todo.write_date, todo.create_date)
+    where = None
+    if since:
+        where = timestamp >= since
+    cursor = _cursor(batch)
+    cursor.execute(*todo.join(location, 'LEFT',
+            condition=todo.location == location.id
+            ).select(*([getattr(todo, f) for f in FIELDS]
+                + [location.name]),
+            where=where,
+            order_by=[timestamp, todo.id]))
+    relation_cursor = Transaction().connection.cursor()
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            break
+        todos = {}
+        for row in rows:
+            values = dict(zip(FIELDS, row))
+            values['location'] = row[-1]
+            values['categories'] = []
+            values['attendees'] = []
+            todos[values['id']] = values
+
+        relation_cursor.execute(*todo_category.join(category,
+                condition=todo_category.category == category.id
+                ).select(todo_category.todo, category.name,
+                where=reduce_ids(todo_category.todo, todos.keys())))
+        for todo_id, name in relation_cursor.fetchall():
+            todos[todo_id]['categories'].append(name)
+        relation_cursor.execute(*attendee.select(
+                attendee.todo, attendee.email, attendee.status,
+                where=reduce_ids(attendee.todo, todos.keys())))
+        for todo_id, email, status in relation_cursor.fetchall():
+            todos[todo_id]['attendees'].append({
+                    'email': email,
+                    'status': status,
+                    })
+
+        for row in rows:
+            yield todos[row[0]]
+    cursor.close()
+
+
+def _default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def main():
+    from trytond.config import config
+
+    parser = argparse.ArgumentParser(
+        description='Export the todos as JSON lines')
+    parser.add_argument('-c', '--config', dest='configfile',
+        help='specify config file')
+    parser.add_argument('-d', '--database', dest='database_name',
+        required=True, help='specify the database name')
+    parser.add_argument('--since',
+        help='export only the todos modified since the ISO date')
+    parser.add_argument('--batch', type=int, default=1000,
+        help='number of todos read at once')
+    parser.add_argument('-o', '--output', default='-',
+        help='file to write the JSON lines to')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config.update_etc(options.configfile)
+    database_name = options.database_name
+    since = None
+    if options.since:
+        since = datetime.datetime.strptime(options.since[:19],
+            '%Y-%m-%dT%H:%M:%S')
+
+    Pool.start()
+    Pool(database_name).init()
+    if options.output == '-':
+        output = sys.stdout
+    else:
+        output = open(options.output, 'wb')
+    try:
+        with Transaction().start(database_name, 0, readonly=True):
+            count, last = 0, since
+            for values in export_todos(since=since, batch=options.batch):
+                json.dump(values, output, default=_default,
+                    separators=(',', ':'))
+                output.write('\n')
+                count += 1
+                last = values['write_date'] or values['create_date']
+            logger.info('%s todos exported, next since: %s', count,
+                _default(last) if isinstance(last, datetime.datetime)
+                else last)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
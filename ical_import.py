@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Import the VTODOs of a large iCalendar file into a calendar
+
+The file is split into one VCALENDAR per UID, which are parsed in parallel by
+a pool of processes into plain values, and a single writer creates the todos
+by batches:
+
+    python -m trytond.modules.calendar_todo.ical_import -c trytond.conf \
+-d database calendar todos.ics
+'''
+import sys
+import logging
+import argparse
+import multiprocessing
+from collections import OrderedDict
+from itertools import islice
+
+import vobject
+
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+
+__all__ = ['split_ical', 'import_todos']
+
+logger = logging.getLogger(__name__)
+
+
+def _unfold(lines):
+    'Yield the logical lines of the iCalendar lines'
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current:
+        yield current
+
+
+def split_ical(lines):
+    '''
+    Split the lines of an iCalendar into one VCALENDAR per UID containing
+    all its VTODOs and all the VTIMEZONEs
+    '''
+    timezones = []
+    todos = OrderedDict()
+    component, block, uid = None, [], None
+    for line in _unfold(lines):
+        name = line.upper()
+        if component is None:
+            if name in ('BEGIN:VTODO', 'BEGIN:VTIMEZONE'):
+                component, block, uid = name[6:], [line], None
+            continue
+        block.append(line)
+        if (component == 'VTODO' and uid is None
+                and name.startswith(('UID:', 'UID;'))):
+            uid = line.split(':', 1)[1]
+        if name == 'END:' + component:
+            if component == 'VTIMEZONE':
+                timezones.extend(block)
+            else:
+                todos.setdefault(uid or object(), []).extend(block)
+            component = None
+    header = ['BEGIN:VCALENDAR', 'VERSION:2.0',
+        'PRODID:-//Tryton//calendar_todo import//EN'] + timezones
+    for block in todos.itervalues():
+        yield '\r\n'.join(header + block + ['END:VCALENDAR', ''])
+
+
+def _parse(args):
+    'Parse the iCalendars into plain values in a worker process'
+    database_name, icals = args
+    result = []
+    with Transaction().start(database_name, 0, readonly=True):
+        Todo = Pool().get('calendar.todo')
+        for data in icals:
+            try:
+                ical = vobject.readOne(data)
+                result.append(Todo.ical2plain(ical))
+            except Exception:
+                logger.warning('Unable to parse VTODO:\n%s', data,
+                    exc_info=True)
+    return result
+
+
+def _init_worker(database_name):
+    Pool.start()
+    Pool(database_name).init()
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_todos(calendar_id, plains, batch=100):
+    '''
+    Create in the calendar the todos of the plain values from the iterator
+    by batches, skipping the UUIDs already in the calendar.
+    Yield the number of created and skipped todos of each batch.
+    '''
+    Todo = Pool().get('calendar.todo')
+
+    categories, locations = {}, {}
+    for chunk in _chunks(plains, batch):
+        # Archived todos keep their UUID
+        with Transaction().set_context(active_test=False):
+            existing = set(t.uuid for t in Todo.search([
+                        ('calendar', '=', calendar_id),
+                        ('uuid', 'in', [p['uuid'] for p in chunk]),
+                        ('parent', '=', None),
+                        ]))
+        vlist = []
+        for plain in chunk:
+            if plain['uuid'] in existing:
+                continue
+            existing.add(plain['uuid'])
+            vlist.append(Todo.plain2values(None, plain, calendar_id,
+                    categories=categories, locations=locations))
+        Todo.create(vlist)
+        yield len(vlist), len(chunk) - len(vlist)
+
+
+def main():
+    from trytond.config import config
+
+    parser = argparse.ArgumentParser(
+        description='Import the VTODOs of an iCalendar file')
+    parser.add_argument('-c', '--config', dest='configfile',
+        help='specify config file')
+    parser.add_argument('-d', '--database', dest='database_name',
+        required=True, help='specify the database name')
+    parser.add_argument('-j', '--processes', type=int,
+        default=multiprocessing.cpu_count(),
+        help='number of parsing processes')
+    parser.add_argument('--batch', type=int, default=100,
+        help='number of todos created per batch')
+    parser.add_argument('--chunk', type=int, default=50,
+        help='number of VTODOs sent at once to a process')
+    parser.add_argument('calendar', help='the name of the calendar')
+    parser.add_argument('file', help='the iCalendar file')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config.update_etc(options.configfile)
+    database_name = options.database_name
+
+    # Fork the workers before any connection to the database
+    workers = multiprocessing.Pool(options.processes, _init_worker,
+        (database_name,))
+    try:
+        _init_worker(database_name)
+        with open(options.file, 'rb') as fp:
+            chunks = ((database_name, c)
+                for c in _chunks(split_ical(fp), options.chunk))
+            plains = (p for r in workers.imap(_parse, chunks) for p in r)
+
+            with Transaction().start(database_name, 0) as transaction:
+                Calendar = Pool().get('calendar.calendar')
+                calendar, = Calendar.search([
+                        ('name', '=', options.calendar),
+                        ])
+                created = skipped = 0
+                for c, s in import_todos(calendar.id, plains,
+                        batch=options.batch):
+                    transaction.commit()
+                    created += c
+                    skipped += s
+                    logger.info('%s todos created, %s skipped',
+                        created, skipped)
+    finally:
+        workers.close()
+        workers.join()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Optional instrumentation of the CalDAV todo hot paths
+
+It is activated with the configuration:
+
+    [calendar_todo]
+    instrument = True
+
+When activated, each measured operation records its wall time and the number
+of SQL queries it executed, and the caches record their hits and misses. The
+counters are read with snapshot() and each outermost operation is logged.
+'''
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['QueryCounter', 'measure', 'measured', 'hit', 'miss',
+    'snapshot', 'reset']
+
+logger = logging.getLogger(__name__)
+
+ENABLED = config.getboolean('calendar_todo', 'instrument', default=False)
+
+_lock = threading.Lock()
+_local = threading.local()
+_operations = {}
+_caches = {}
+
+
+class QueryCounter(object):
+    'Wrap a connection to count the executed queries'
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.count = 0
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self,
+            self._connection.cursor(*args, **kwargs))
+
+
+class _CountingCursor(object):
+
+    def __init__(self, counter, cursor):
+        self._counter = counter
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+
+@contextmanager
+def measure(name):
+    'Record the wall time and the queries of the block as operation name'
+    if not ENABLED:
+        yield
+        return
+    transaction = Transaction()
+    stack = _local.__dict__.setdefault('stack', [])
+    counter = getattr(transaction, 'connection', None)
+    installed = None
+    if counter is not None and not isinstance(counter, QueryCounter):
+        counter = installed = transaction.connection = QueryCounter(counter)
+    queries = counter.count if isinstance(counter, QueryCounter) else 0
+    frame = {}
+    stack.append(frame)
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        if isinstance(counter, QueryCounter):
+            queries = counter.count - queries
+        else:
+            queries = 0
+        stack.pop()
+        if installed is not None:
+            transaction.connection = installed._connection
+        with _lock:
+            _add(_operations, name, duration, queries)
+        if stack:
+            _add(stack[-1], name, duration, queries)
+        else:
+            logger.info('%s: %.2fms, %s queries%s', name, duration * 1000,
+                queries, ''.join(', %s: %s x %.2fms %s queries' % (
+                        n, v['calls'], v['time'] * 1000, v['queries'])
+                    for n, v in sorted(frame.iteritems())))
+
+
+def _add(operations, name, duration, queries):
+    values = operations.setdefault(name, {
+            'calls': 0,
+            'time': 0.,
+            'max': 0.,
+            'queries': 0,
+            })
+    values['calls'] += 1
+    values['time'] += duration
+    values['max'] = max(values['max'], duration)
+    values['queries'] += queries
+
+
+def measured(name):
+    'Decorate a function to measure it as operation name'
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def hit(name):
+    'Record a hit of the cache name'
+    if ENABLED:
+        with _lock:
+            _caches.setdefault(name, [0, 0])[0] += 1
+
+
+def miss(name):
+    'Record a miss of the cache name'
+    if ENABLED:
+        with _lock:
+            _caches.setdefault(name, [0, 0])[1] += 1
+
+
+def snapshot():
+    'Return a copy of the counters of the process'
+    with _lock:
+        operations = dict((n, v.copy()) for n, v in _operations.iteritems())
+        caches = {}
+        for name, (hits, misses) in _caches.iteritems():
+            caches[name] = {
+                'hits': hits,
+                'misses': misses,
+                'ratio': float(hits) / (hits + misses),
+                }
+    return {
+        'operations': operations,
+        'caches': caches,
+        }
+
+
+def reset():
+    'Reset the counters of the process'
+    with _lock:
+        _operations.clear()
+        _caches.clear()
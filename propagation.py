@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Deferred propagation of the todos to the calendars of the attendees
+
+It is activated with the configuration:
+
+    [calendar_todo]
+    deferred_propagation = True
+
+The changes of the todos are then recorded in a queue which is processed,
+each entry in its own transaction, by:
+
+    python -m trytond.modules.calendar_todo.propagation -c trytond.conf \
+-d database
+'''
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import traceback
+
+from trytond.model import ModelSQL, fields, Unique
+from trytond.config import config
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+
+__all__ = ['TodoPropagation']
+
+logger = logging.getLogger(__name__)
+
+
+class TodoPropagation(ModelSQL):
+    'Todo Propagation'
+    __name__ = 'calendar.todo.propagation'
+    key = fields.Char('Key', required=True,
+        help='Identifies the work to not record it twice.')
+    operation = fields.Selection([
+            ('update', 'Update'),
+            ('delete', 'Delete'),
+            ('decline', 'Decline'),
+            ('attendee', 'Attendee Update'),
+            ('attendee_delete', 'Attendee Delete'),
+            ], 'Operation', required=True)
+    todo = fields.Integer('Todo')
+    data = fields.Text('Data')
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, select=True)
+    attempts = fields.Integer('Attempts', required=True)
+    next_attempt = fields.DateTime('Next Attempt')
+    error = fields.Text('Error')
+
+    @classmethod
+    def __setup__(cls):
+        super(TodoPropagation, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints = [
+            ('key_uniq', Unique(t, t.key), 'The key must be unique.'),
+            ]
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @staticmethod
+    def deferred():
+        'Test if the propagation is deferred'
+        return config.getboolean('calendar_todo', 'deferred_propagation',
+            default=False)
+
+    @classmethod
+    def _enqueue(cls, entries):
+        '''
+        Record the entries of key, operation, todo id and data. The entries
+        with a key already recorded are reset to pending.
+        The table is locked to not record a key twice concurrently.
+        '''
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        entries = dict((e[0], e) for e in entries)
+        if not entries:
+            return
+        transaction.database.lock(transaction.connection, cls._table)
+        now = datetime.datetime.now()
+        existing = set()
+        for sub_keys in grouped_slice(entries.keys()):
+            cursor.execute(*table.select(table.key,
+                    where=table.key.in_(list(sub_keys))))
+            existing.update(k for k, in cursor.fetchall())
+        for sub_keys in grouped_slice(existing):
+            # The write date tells the worker the entry was reset
+            cursor.execute(*table.update(
+                    columns=[table.state, table.attempts, table.next_attempt,
+                        table.error, table.write_uid, table.write_date],
+                    values=['pending', 0, None, None, transaction.user, now],
+                    where=table.key.in_(list(sub_keys))))
+
+        values = [list(e) + ['pending', 0, transaction.user, now]
+            for k, e in entries.iteritems() if k not in existing]
+        for sub_values in grouped_slice(values):
+            cursor.execute(*table.insert(
+                    columns=[table.key, table.operation, table.todo,
+                        table.data, table.state, table.attempts,
+                        table.create_uid, table.create_date],
+                    values=list(sub_values)))
+
+    @classmethod
+    def enqueue_update(cls, todos):
+        '''
+        Record the update of the copies of the todos organized by the owner
+        of their calendar
+        '''
+        Todo = Pool().get('calendar.todo')
+        cls._enqueue([('update:%s' % t.id, 'update', t.id, None)
+                for t in todos if Todo._attendee_emails(t)])
+
+    @classmethod
+    def enqueue_delete(cls, todos):
+        '''
+        Record the deletion of the copies of the todos organized by the owner
+        of their calendar or the decline of the invitation of the organizer
+        '''
+        Todo = Pool().get('calendar.todo')
+        entries = []
+        for todo in todos:
+            owner = todo.calendar.owner
+            attendee_emails = Todo._attendee_emails(todo)
+            if attendee_emails is not None:
+                if attendee_emails:
+                    data = {
+                        'uuid': todo.uuid,
+                        'recurrence': todo.recurrence,
+                        'emails': attendee_emails,
+                        }
+                    entries.append(('delete:%s' % todo.id, 'delete', todo.id,
+                            data))
+            elif owner and (todo.organizer
+                    or (todo.parent and todo.parent.organizer)):
+                data = {
+                    'uuid': todo.uuid,
+                    'recurrence': todo.recurrence,
+                    'organizer': todo.organizer or todo.parent.organizer,
+                    'email': owner.email,
+                    }
+                entries.append(('decline:%s' % todo.id, 'decline', todo.id,
+                        data))
+        cls._enqueue([(k, o, i, json.dumps(d, default=_default))
+                for k, o, i, d in entries])
+
+    @classmethod
+    def enqueue_attendee_update(cls, attendees):
+        '''
+        Record the update of the attendees on the copies of their todo
+        organized by the owner of its calendar
+        '''
+        Todo = Pool().get('calendar.todo')
+        cls._enqueue([('attendee:%s' % a.id, 'attendee', a.todo.id,
+                    json.dumps({'attendee': a.id}))
+                for a in attendees if Todo._attendee_emails(a.todo)])
+
+    @classmethod
+    def enqueue_attendee_delete(cls, attendees):
+        '''
+        Record the deletion or the decline of the copies of the attendees
+        '''
+        Attendee = Pool().get('calendar.todo.attendee')
+        entries = []
+        for attendee in attendees:
+            delete_keys, decline_keys = Attendee._delete_keys(attendee)
+            if delete_keys or decline_keys:
+                data = {
+                    'delete': delete_keys,
+                    'decline': decline_keys,
+                    }
+                entries.append(('attendee_delete:%s' % attendee.id,
+                        'attendee_delete', attendee.todo.id,
+                        json.dumps(data, default=_default)))
+        cls._enqueue(entries)
+
+    @classmethod
+    def process(cls, entry_id):
+        '''
+        Run the entry and delete it unless it was reset meanwhile, it is
+        called by the worker in its own transaction
+        '''
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Attendee = pool.get('calendar.todo.attendee')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        entry = cls(entry_id)
+        # Read from the table as the entry may be reset by raw queries
+        cursor.execute(*table.select(table.write_date,
+                where=table.id == entry_id))
+        write_date, = cursor.fetchone()
+        data = json.loads(entry.data) if entry.data else {}
+        recurrence = _datetime(data.get('recurrence'))
+        with Transaction().set_user(0), \
+                Transaction().set_context(active_test=False):
+            if entry.operation == 'update':
+                # The update creates only the missing copies
+                todos = Todo.search([('id', '=', entry.todo)])
+                Todo._propagate_update(todos)
+            elif entry.operation == 'delete':
+                Todo.delete(Todo.search([
+                            ('uuid', '=', data['uuid']),
+                            ('calendar.owner.email', 'in', data['emails']),
+                            ('id', '!=', entry.todo),
+                            ('recurrence', '=', recurrence),
+                            ]))
+            elif entry.operation == 'decline':
+                attendees = Attendee.search([
+                        ('todo.uuid', '=', data['uuid']),
+                        ('todo.calendar.owner.email', '=',
+                            data['organizer']),
+                        ('todo.recurrence', '=', recurrence),
+                        ('email', '=', data['email']),
+                        ('status', '!=', 'declined'),
+                        ])
+                if attendees:
+                    Attendee.write(attendees, {
+                            'status': 'declined',
+                            })
+            elif entry.operation == 'attendee':
+                attendees = Attendee.search([
+                        ('id', '=', data['attendee']),
+                        ])
+                Attendee._propagate_update(attendees)
+            elif entry.operation == 'attendee_delete':
+                keys = dict((n, [(u, _datetime(r), e, tuple(o))
+                                for u, r, e, o in data[n]])
+                    for n in ['delete', 'decline'])
+                Attendee._propagate_delete(keys['delete'], keys['decline'])
+        cursor.execute(*table.delete(
+                where=(table.id == entry_id)
+                & (table.write_date == write_date)))
+
+    @classmethod
+    def fail(cls, entry_id, error):
+        '''
+        Record the failure of the entry and schedule its retry with an
+        exponential delay until the max_attempts of the configuration
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        max_attempts = config.getint('calendar_todo',
+            'propagation_max_attempts', default=5)
+        cursor.execute(*table.select(table.attempts,
+                where=table.id == entry_id))
+        attempts, = cursor.fetchone()
+        attempts += 1
+        next_attempt = datetime.datetime.now() + datetime.timedelta(
+            minutes=2 ** attempts)
+        cursor.execute(*table.update(
+                columns=[table.attempts, table.next_attempt, table.error,
+                    table.state],
+                values=[attempts, next_attempt, error,
+                    'failed' if attempts >= max_attempts else 'pending'],
+                where=reduce_ids(table.id, [entry_id])))
+
+    @classmethod
+    def pending(cls, limit=None):
+        'Return the ids of the pending entries to run now'
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.select(table.id,
+                where=(table.state == 'pending')
+                & ((table.next_attempt == None)
+                    | (table.next_attempt <= datetime.datetime.now())),
+                order_by=table.id, limit=limit))
+        return [i for i, in cursor.fetchall()]
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%S')
+    raise TypeError(repr(value))
+
+
+def _datetime(value):
+    if value:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def run(database_name, batch=100):
+    '''
+    Process the pending entries of the queue each in its own transaction
+    and return the number of processed entries
+    '''
+    processed = 0
+    while True:
+        with Transaction().start(database_name, 0, readonly=True):
+            Propagation = Pool().get('calendar.todo.propagation')
+            entry_ids = Propagation.pending(limit=batch)
+        if not entry_ids:
+            return processed
+        for entry_id in entry_ids:
+            with Transaction().start(database_name, 0) as transaction:
+                Propagation = Pool().get('calendar.todo.propagation')
+                try:
+                    Propagation.process(entry_id)
+                except Exception:
+                    transaction.rollback()
+                    logger.warning('Propagation %s failed', entry_id,
+                        exc_info=True)
+                    Propagation.fail(entry_id, traceback.format_exc())
+                transaction.commit()
+            processed += 1
+        if len(entry_ids) < batch:
+            return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Propagate the todos to the calendars of the attendees')
+    parser.add_argument('-c', '--config', dest='configfile',
+        help='specify config file')
+    parser.add_argument('-d', '--database', dest='database_name',
+        required=True, help='specify the database name')
+    parser.add_argument('--batch', type=int, default=100,
+        help='number of entries fetched at once')
+    parser.add_argument('--loop', type=int, default=0,
+        help='seconds to wait between runs, 0 to run once')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config.update_etc(options.configfile)
+    database_name = options.database_name
+
+    Pool.start()
+    Pool(database_name).init()
+    while True:
+        processed = run(database_name, batch=options.batch)
+        if processed:
+            logger.info('%s propagations processed', processed)
+        if not options.loop:
+            break
+        time.sleep(options.loop)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Benchmark of the CalDAV todo operations of webdav.collection
+
+The database is selected like for the tests with the TRYTOND_DATABASE_URI
+and DB_NAME environment variables. The report is written as JSON.
+
+    DB_NAME=:memory: python -m trytond.modules.calendar_todo.tests.\
+benchmark_caldav --todos 1000
+'''
+import sys
+import uuid
+import json
+import time
+import argparse
+import datetime
+import xml.dom.minidom
+
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER, \
+    CONTEXT
+from trytond import backend
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.modules.calendar_todo.instrument import QueryCounter
+
+VALARM = '''BEGIN:VALARM
+ACTION:DISPLAY
+DESCRIPTION:Reminder
+TRIGGER:-PT15M
+END:VALARM
+'''
+
+
+def percentile(values, percent):
+    'Return the nearest-rank percentile of values'
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+class Recorder(object):
+    'Record the duration and the query count of each operation'
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.samples = {}
+
+    def run(self, name, func, *args, **kwargs):
+        count = self.counter.count
+        start = time.time()
+        result = func(*args, **kwargs)
+        duration = time.time() - start
+        self.samples.setdefault(name, []).append(
+            (duration, self.counter.count - count))
+        return result
+
+    def report(self):
+        result = {}
+        for name, samples in self.samples.iteritems():
+            durations = [d * 1000 for d, _ in samples]
+            queries = [q for _, q in samples]
+            result[name] = {
+                'samples': len(samples),
+                'latency_ms': {
+                    'min': min(durations),
+                    'p50': percentile(durations, 50),
+                    'p90': percentile(durations, 90),
+                    'p99': percentile(durations, 99),
+                    'max': max(durations),
+                    },
+                'queries': {
+                    'total': sum(queries),
+                    'mean': float(sum(queries)) / len(queries),
+                    'max': max(queries),
+                    },
+                }
+        return result
+
+
+def populate(options):
+    'Create the calendars and the synthetic todos'
+    pool = Pool()
+    User = pool.get('res.user')
+    Calendar = pool.get('calendar.calendar')
+    Todo = pool.get('calendar.todo')
+
+    owner, peer = User.create([{
+                'name': 'Benchmark Owner',
+                'login': 'bench_owner',
+                'email': 'owner@bench.example.com',
+                }, {
+                'name': 'Benchmark Peer',
+                'login': 'bench_peer',
+                'email': 'peer@bench.example.com',
+                }])
+    calendar, _ = Calendar.create([{
+                'name': 'bench',
+                'owner': owner.id,
+                }, {
+                'name': 'bench_peer',
+                'owner': peer.id,
+                }])
+
+    start = datetime.datetime(2017, 1, 2, 9, 0)
+    vlist = []
+    for i in xrange(options.todos):
+        dtstart = start + datetime.timedelta(hours=i)
+        values = {
+            'calendar': calendar.id,
+            'uuid': str(uuid.uuid4()),
+            'summary': 'Todo %s' % i,
+            'description': 'Synthetic todo number %s' % i,
+            'dtstart': dtstart,
+            'due': dtstart + datetime.timedelta(days=1),
+            'status': ('needs-action', 'in-process', 'completed')[i % 3],
+            }
+        if options.recurring and not i % options.recurring:
+            values['rrules'] = [('create', [{
+                            'freq': 'weekly',
+                            'count': 10,
+                            }])]
+            values['occurences'] = [('create', [{
+                            'calendar': calendar.id,
+                            'uuid': values['uuid'],
+                            'recurrence': dtstart + datetime.timedelta(
+                                weeks=1),
+                            'summary': 'Todo %s moved' % i,
+                            }])]
+        if options.attendees:
+            values['organizer'] = owner.email
+            emails = ['attendee%s@bench.example.com' % j
+                for j in xrange(options.attendees)]
+            if options.shared and not i % options.shared:
+                emails[0] = peer.email
+            values['attendees'] = [('create', [{
+                            'email': email,
+                            'status': 'needs-action',
+                            } for email in emails])]
+        if options.alarms:
+            values['alarms'] = [('create', [{
+                            'valarm': VALARM,
+                            }])]
+        vlist.append(values)
+        if len(vlist) >= options.batch:
+            Todo.create(vlist)
+            vlist = []
+    if vlist:
+        Todo.create(vlist)
+    return calendar
+
+
+def multiget_filter(hrefs):
+    'Return a calendar-multiget REPORT element for the hrefs'
+    doc = xml.dom.minidom.parseString(
+        '<C:calendar-multiget xmlns:D="DAV:" '
+        'xmlns:C="urn:ietf:params:xml:ns:caldav">'
+        '<D:prop><D:getetag/><C:calendar-data/></D:prop>'
+        + ''.join('<D:href>%s</D:href>' % h for h in hrefs)
+        + '</C:calendar-multiget>')
+    return doc.documentElement
+
+
+def benchmark(options, recorder, calendar):
+    Collection = Pool().get('webdav.collection')
+    dbname = Transaction().database.name
+    collection_uri = 'Calendars/%s' % calendar.name
+
+    for _ in xrange(options.repeat):
+        cache = {}
+        childs = recorder.run('get_childs', Collection.get_childs,
+            collection_uri, cache=cache)
+
+        def propfind():
+            for child in childs:
+                uri = '%s/%s' % (collection_uri, child)
+                Collection.get_resourcetype(uri, cache=cache)
+                Collection.get_contenttype(uri, cache=cache)
+                Collection.get_creationdate(uri, cache=cache)
+                Collection.get_lastmodified(uri, cache=cache)
+        recorder.run('propfind', propfind)
+
+    uris = ['%s/%s' % (collection_uri, c)
+        for c in Collection.get_childs(collection_uri)]
+    step = max(1, len(uris) // options.samples)
+    sample = uris[::step][:options.samples]
+
+    for _ in xrange(options.repeat):
+        filter = multiget_filter(
+            '/%s/%s' % (dbname, uri) for uri in sample)
+
+        def multiget():
+            for child in Collection.get_childs(collection_uri,
+                    filter=filter):
+                Collection.get_data('%s/%s' % (collection_uri, child))
+        recorder.run('multiget', multiget)
+
+    datas = {}
+    for uri in sample:
+        datas[uri] = recorder.run('get_data', Collection.get_data, uri)
+    for uri in sample:
+        recorder.run('put', Collection.put, uri, datas[uri],
+            'text/calendar')
+    for uri in sample:
+        recorder.run('rm', Collection.rm, uri)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the CalDAV operations on todos')
+    parser.add_argument('--todos', type=int, default=1000,
+        help='number of todos to create')
+    parser.add_argument('--recurring', type=int, default=10,
+        help='make one todo out of N recurring (0 to disable)')
+    parser.add_argument('--attendees', type=int, default=2,
+        help='number of attendees per todo')
+    parser.add_argument('--shared', type=int, default=0,
+        help='invite the peer calendar to one todo out of N')
+    parser.add_argument('--alarms', action='store_true', default=True)
+    parser.add_argument('--no-alarms', dest='alarms', action='store_false')
+    parser.add_argument('--batch', type=int, default=1000,
+        help='number of todos created per call')
+    parser.add_argument('--samples', type=int, default=100,
+        help='number of todos used for the per item operations')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='number of runs of the collection operations')
+    parser.add_argument('--output', default='-',
+        help='file to write the JSON report to')
+    options = parser.parse_args()
+
+    activate_module('calendar_todo')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        counter = QueryCounter(transaction.connection)
+        transaction.connection = counter
+        try:
+            start = time.time()
+            calendar = populate(options)
+            populate_duration = time.time() - start
+            recorder = Recorder(counter)
+            benchmark(options, recorder, calendar)
+        finally:
+            transaction.connection = counter._connection
+
+    report = {
+        'backend': backend.name(),
+        'database': DB_NAME,
+        'options': vars(options),
+        'populate_s': populate_duration,
+        'operations': recorder.report(),
+        }
+    if options.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
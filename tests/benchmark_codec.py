@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Micro-benchmark of the iCalendar conversions of calendar.todo
+
+For each VTODO of the corpus, it measures separately the throughput and
+the allocations of the parse to values (vobject.readOne and
+Todo.ical2values) and of the record to iCalendar (Todo.todo2ical and
+serialize). The allocations are counted as the objects tracked by the
+garbage collector which are created by one call and still alive at its
+end, and also in bytes if tracemalloc is available.
+
+The database is selected like for the tests with the TRYTOND_DATABASE_URI
+and DB_NAME environment variables. The report is written as JSON.
+
+The results depend on the machine and on the interpreter and the objects
+are too few to detect a regression from a ratio, so there is no baseline.
+A change is checked by comparing its report to the report of its parent
+made on the same machine:
+
+    git stash
+    DB_NAME=:memory: python -m trytond.modules.calendar_todo.tests.\
+benchmark_codec --output /tmp/before.json
+    git stash pop
+    DB_NAME=:memory: python -m trytond.modules.calendar_todo.tests.\
+benchmark_codec --output /tmp/after.json
+    diff /tmp/before.json /tmp/after.json
+'''
+import sys
+import gc
+import json
+import time
+import argparse
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER, \
+    CONTEXT
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+
+HEADER = '''BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Tryton//calendar_todo benchmark//EN
+'''
+FOOTER = '''END:VCALENDAR
+'''
+
+SIMPLE = HEADER + '''BEGIN:VTODO
+UID:simple@bench.example.com
+DTSTAMP:20170102T090000Z
+SUMMARY:Simple todo
+DUE:20170103T090000Z
+STATUS:NEEDS-ACTION
+END:VTODO
+''' + FOOTER
+
+RECURRING = HEADER + '''BEGIN:VTODO
+UID:recurring@bench.example.com
+DTSTAMP:20170102T090000Z
+SUMMARY:Recurring todo
+DESCRIPTION:Weekly todo with exceptions
+DTSTART:20170102T090000Z
+DUE:20170102T170000Z
+RRULE:FREQ=WEEKLY;COUNT=20;BYDAY=MO,TH
+EXRULE:FREQ=MONTHLY;COUNT=3;BYMONTHDAY=1
+RDATE:20170115T090000Z,20170215T090000Z
+EXDATE:20170109T090000Z,20170116T090000Z
+STATUS:IN-PROCESS
+PERCENT-COMPLETE:40
+END:VTODO
+BEGIN:VTODO
+UID:recurring@bench.example.com
+RECURRENCE-ID:20170105T090000Z
+DTSTAMP:20170102T090000Z
+SUMMARY:Recurring todo moved
+DTSTART:20170106T090000Z
+DUE:20170106T170000Z
+STATUS:COMPLETED
+COMPLETED:20170106T120000Z
+END:VTODO
+''' + FOOTER
+
+ATTENDEES = HEADER + '''BEGIN:VTODO
+UID:attendees@bench.example.com
+DTSTAMP:20170102T090000Z
+SUMMARY:Todo with many attendees
+DUE:20170110T090000Z
+ORGANIZER:MAILTO:organizer@bench.example.com
+''' + ''.join('ATTENDEE;PARTSTAT=%s:MAILTO:attendee%s@bench.example.com\n'
+    % (('NEEDS-ACTION', 'ACCEPTED', 'DECLINED')[i % 3], i)
+    for i in xrange(50)) + '''END:VTODO
+''' + FOOTER
+
+ALARMS = HEADER + '''BEGIN:VTODO
+UID:alarms@bench.example.com
+DTSTAMP:20170102T090000Z
+SUMMARY:Todo with alarms and categories
+DUE:20170110T090000Z
+CATEGORIES:Work,Home,Urgent,Project A,Project B
+LOCATION:Office
+CLASS:PRIVATE
+BEGIN:VALARM
+ACTION:DISPLAY
+DESCRIPTION:Reminder
+TRIGGER:-PT15M
+END:VALARM
+BEGIN:VALARM
+ACTION:DISPLAY
+DESCRIPTION:Second reminder
+TRIGGER:-P1D
+END:VALARM
+BEGIN:VALARM
+ACTION:EMAIL
+DESCRIPTION:Mail reminder
+SUMMARY:Reminder
+ATTENDEE:MAILTO:organizer@bench.example.com
+TRIGGER:-PT1H
+END:VALARM
+END:VTODO
+''' + FOOTER
+
+TIMEZONE = HEADER + '''BEGIN:VTIMEZONE
+TZID:America/New_York
+BEGIN:STANDARD
+DTSTART:19701101T020000
+RRULE:FREQ=YEARLY;BYMONTH=11;BYDAY=1SU
+TZOFFSETFROM:-0400
+TZOFFSETTO:-0500
+TZNAME:EST
+END:STANDARD
+BEGIN:DAYLIGHT
+DTSTART:19700308T020000
+RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=2SU
+TZOFFSETFROM:-0500
+TZOFFSETTO:-0400
+TZNAME:EDT
+END:DAYLIGHT
+END:VTIMEZONE
+BEGIN:VTODO
+UID:timezone@bench.example.com
+DTSTAMP:20170102T090000Z
+SUMMARY:Todo in a foreign timezone
+DTSTART;TZID=America/New_York:20170102T090000
+DUE;TZID=America/New_York:20170102T170000
+RRULE:FREQ=DAILY;COUNT=5
+END:VTODO
+''' + FOOTER
+
+CORPUS = [
+    ('simple', SIMPLE),
+    ('recurring', RECURRING),
+    ('attendees', ATTENDEES),
+    ('alarms', ALARMS),
+    ('timezone', TIMEZONE),
+    ]
+
+
+def count_objects(func):
+    '''
+    Return the number of objects tracked by the garbage collector created
+    by one call of func and alive until its result is released
+    '''
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        result = func()
+        objects = len(gc.get_objects()) - before
+    finally:
+        gc.enable()
+    del result
+    return objects
+
+
+def measure(func, number, repeat):
+    '''
+    Return the best number of calls per second of func, the number of
+    objects and the memory in bytes allocated by one call or None without
+    tracemalloc
+    '''
+    func()
+    best = None
+    gc.collect()
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    allocated = None
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            after, peak = tracemalloc.get_traced_memory()
+            allocated = peak - before
+        finally:
+            tracemalloc.stop()
+    return number / best, count_objects(func), allocated
+
+
+def benchmark(options):
+    'Return the results of the corpus per VTODO and per conversion'
+    import vobject
+
+    pool = Pool()
+    Calendar = pool.get('calendar.calendar')
+    Todo = pool.get('calendar.todo')
+    User = pool.get('res.user')
+
+    user, = User.create([{
+                'name': 'Benchmark Organizer',
+                'login': 'bench_organizer',
+                'email': 'organizer@bench.example.com',
+                }])
+    calendar, = Calendar.create([{
+                'name': 'bench_codec',
+                'owner': user.id,
+                }])
+
+    results = {}
+    for name, data in CORPUS:
+        def parse():
+            ical = vobject.readOne(data)
+            return Todo.ical2values(None, ical, calendar.id)
+        todo, = Todo.create([parse()])
+
+        def serialize():
+            return Todo(todo.id).todo2ical().serialize()
+
+        results[name] = {}
+        for conversion, func in [
+                ('parse', parse),
+                ('serialize', serialize),
+                ]:
+            per_s, objects, allocated = measure(func, options.number,
+                options.repeat)
+            results[name][conversion] = {
+                'per_s': per_s,
+                'objects': objects,
+                'allocated': allocated,
+                }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the iCalendar conversions of todos')
+    parser.add_argument('--number', type=int, default=50,
+        help='number of conversions per run')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='number of runs of which the best is kept')
+    parser.add_argument('--output', default='-',
+        help='file to write the JSON report to')
+    options = parser.parse_args()
+
+    activate_module('calendar_todo')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        try:
+            results = benchmark(options)
+        finally:
+            transaction.rollback()
+
+    if options.output == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Benchmark of the initialization of the pool with calendar_todo
+
+Each sample starts a new interpreter, initializes the pool of a database
+where calendar_todo is activated and reports the time spent from the first
+import of trytond and the iCalendar libraries loaded. The database is
+selected with the TRYTOND_DATABASE_URI and DB_NAME environment variables
+and can not be in memory. The report is written as JSON.
+
+    DB_NAME=test python -m trytond.modules.calendar_todo.tests.\
+benchmark_import
+
+The calendar module, on which calendar_todo depends, imports the iCalendar
+libraries at load so importing them on first use in calendar_todo does not
+change the initialization time.
+'''
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+LIBRARIES = ['vobject', 'pytz', 'dateutil.tz', 'xml.dom.minidom']
+
+SAMPLE = '''
+import sys, time, json
+start = time.time()
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+Pool.start()
+with Transaction().start(%(database)r, 0):
+    Pool(%(database)r).init()
+duration = time.time() - start
+json.dump({
+        'time': duration,
+        'loaded': [m for m in %(libraries)r if m in sys.modules],
+        }, sys.stdout)
+'''
+
+
+def sample(database):
+    '''
+    Return the initialization time of the pool of the database and the
+    libraries loaded in a new interpreter
+    '''
+    code = SAMPLE % {
+        'libraries': LIBRARIES,
+        'database': database,
+        }
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the initialization of the pool')
+    parser.add_argument('--database', default=os.environ.get('DB_NAME'),
+        help='the database where calendar_todo is activated')
+    parser.add_argument('--repeat', type=int, default=20,
+        help='number of interpreters started')
+    parser.add_argument('--output', default='-',
+        help='file to write the JSON report to')
+    options = parser.parse_args()
+    if not options.database or options.database == ':memory:':
+        parser.error('a database which is not in memory is required')
+
+    sample(options.database)
+    samples = [sample(options.database) for _ in xrange(options.repeat)]
+    times = sorted(s['time'] * 1000 for s in samples)
+
+    report = {
+        'database': options.database,
+        'pool_init_ms': {
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'max': times[-1],
+            },
+        'loaded': samples[0]['loaded'],
+        }
+    if options.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
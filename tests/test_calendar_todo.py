@@ -1,14 +1,1172 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import uuid
+import urllib
 import unittest
+from contextlib import contextmanager
+import datetime
+import xml.dom.minidom
+from StringIO import StringIO
+
+import vobject
+
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond import backend
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.config import config
+from trytond.pool import Pool
+
+from trytond.modules.calendar_todo.instrument import QueryCounter
+
+# The sizes stay below the IN_MAX of the backends so the slices of the
+# todos are queried at once
+SIZES = (10, 60)
+# The number of queries of each operation whatever the size as measured on
+# each backend, SQLite needs more queries to create records
+QUERY_BUDGETS = {
+    'postgresql': {
+        'get_childs': 2,
+        'properties': 4,
+        'properties_cached': 1,
+        'multiget': 17,
+        'get_data': 10,
+        'put': 20,
+        'put_new': 11,
+        'rm': 15,
+        },
+    'sqlite': {
+        'get_childs': 2,
+        'properties': 4,
+        'properties_cached': 1,
+        'multiget': 17,
+        'get_data': 10,
+        'put': 22,
+        'put_new': 13,
+        'rm': 15,
+        },
+    }
+
+VTODO = '''BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Tryton//calendar_todo test//EN
+BEGIN:VTODO
+UID:%s
+DTSTAMP:20170102T090000Z
+SUMMARY:New todo
+DESCRIPTION:Todo created by put
+DUE:20170103T090000Z
+STATUS:NEEDS-ACTION
+END:VTODO
+END:VCALENDAR
+'''
+
+RECURRING = '''BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Tryton//calendar_todo test//EN
+BEGIN:VTODO
+UID:%(uuid)s
+DTSTAMP:20170102T090000Z
+SUMMARY:Weekly
+DTSTART:20170102T090000Z
+RRULE:FREQ=WEEKLY;COUNT=10
+STATUS:NEEDS-ACTION
+END:VTODO
+BEGIN:VTODO
+UID:%(uuid)s
+RECURRENCE-ID:20170109T090000Z
+DTSTAMP:20170102T090000Z
+SUMMARY:Weekly moved
+DTSTART:20170110T090000Z
+STATUS:NEEDS-ACTION
+END:VTODO
+END:VCALENDAR
+'''
+
+
+def count_queries(func, *args, **kwargs):
+    'Return the result of func and the number of queries it executed'
+    transaction = Transaction()
+    counter = transaction.connection = QueryCounter(transaction.connection)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        transaction.connection = counter._connection
+    return result, counter.count
+
+
+@contextmanager
+def set_config(section, option, value):
+    'Set the option of the configuration in the block'
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, option, value)
+    try:
+        yield
+    finally:
+        config.remove_option(section, option)
+
+
+@contextmanager
+def patch(obj, name, value):
+    'Replace the attribute of the object in the block'
+    missing = object()
+    old = obj.__dict__.get(name, missing)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        if old is missing:
+            delattr(obj, name)
+        else:
+            setattr(obj, name, old)
 
 
 class CalendarTodoTestCase(ModuleTestCase):
     'Test Calendar Todo module'
     module = 'calendar_todo'
 
+    def create_calendar(self, name):
+        'Create a user and its calendar of the name'
+        pool = Pool()
+        User = pool.get('res.user')
+        Calendar = pool.get('calendar.calendar')
+
+        user, = User.create([{
+                    'name': name,
+                    'login': name,
+                    'email': '%s@calendar.example.com' % name,
+                    }])
+        calendar, = Calendar.create([{
+                    'name': name,
+                    'owner': user.id,
+                    }])
+        return user, calendar
+
+    def populate(self, calendar, size):
+        '''
+        Create size todos in the calendar and return them. One todo out of
+        five is recurring except the first ones which are used by the
+        operations.
+        '''
+        Todo = Pool().get('calendar.todo')
+
+        start = datetime.datetime(2017, 1, 2, 9, 0)
+        vlist = []
+        for i in xrange(size):
+            dtstart = start + datetime.timedelta(hours=i)
+            values = {
+                'calendar': calendar.id,
+                'uuid': str(uuid.uuid4()),
+                'summary': 'Todo %s' % i,
+                'description': 'Synthetic todo number %s' % i,
+                'dtstart': dtstart,
+                'due': dtstart + datetime.timedelta(days=1),
+                'status': 'needs-action',
+                }
+            if i >= 10 and not i % 5:
+                values['rrules'] = [('create', [{
+                                'freq': 'weekly',
+                                'count': 10,
+                                }])]
+                values['occurences'] = [('create', [{
+                                'calendar': calendar.id,
+                                'uuid': values['uuid'],
+                                'recurrence': dtstart + datetime.timedelta(
+                                    weeks=1),
+                                'summary': 'Todo %s moved' % i,
+                                }])]
+            vlist.append(values)
+        return Todo.create(vlist)
+
+    def operations(self, calendar, todos):
+        '''
+        Return the number of queries of each CalDAV operation on the
+        calendar. Each operation is run first on other todos to fill the
+        caches which do not depend on the todos.
+        '''
+        Collection = Pool().get('webdav.collection')
+        dbname = Transaction().database.name
+        collection_uri = 'Calendars/%s' % calendar.name
+        uris = ['%s/%s.ics' % (collection_uri, t.uuid) for t in todos]
+        counts = {}
+
+        def cold():
+            Collection._todo_cache_clear([calendar.id])
+
+        list(Collection.get_childs(collection_uri))
+        _, counts['get_childs'] = count_queries(
+            lambda: list(Collection.get_childs(collection_uri, cache={})))
+
+        def properties(uri, cache):
+            Collection.get_creationdate(uri, cache=cache)
+            Collection.get_lastmodified(uri, cache=cache)
+            Collection.get_etag(uri, cache=cache)
+        properties(uris[9], {})
+        cold()
+        cache = {}
+        list(Collection.get_childs(collection_uri, cache=cache))
+        _, counts['properties'] = count_queries(properties, uris[0], cache)
+        _, counts['properties_cached'] = count_queries(
+            properties, uris[1], cache)
+
+        def multiget(hrefs):
+            filter = xml.dom.minidom.parseString(
+                '<C:calendar-multiget xmlns:D="DAV:" '
+                'xmlns:C="urn:ietf:params:xml:ns:caldav">'
+                '<D:prop><D:getetag/><C:calendar-data/></D:prop>'
+                + ''.join('<D:href>/%s/%s</D:href>' % (dbname, h)
+                    for h in hrefs)
+                + '</C:calendar-multiget>').documentElement
+            cache = {}
+            childs = Collection.get_childs(collection_uri, filter=filter,
+                cache=cache)
+            return [Collection.get_data('%s/%s' % (collection_uri, c),
+                    cache=cache) for c in childs]
+        multiget(uris[7:9])
+        cold()
+        _, counts['multiget'] = count_queries(multiget, uris[2:5])
+
+        datas = {}
+        datas[uris[5]] = Collection.get_data(uris[5])
+        cold()
+        datas[uris[6]], counts['get_data'] = count_queries(
+            Collection.get_data, uris[6])
+
+        for uri in uris[5:7]:
+            datas[uri] = datas[uri].replace('Synthetic', 'Changed')
+        Collection.put(uris[5], datas[uris[5]], 'text/calendar')
+        cold()
+        _, counts['put'] = count_queries(
+            Collection.put, uris[6], datas[uris[6]], 'text/calendar')
+
+        uuids = [str(uuid.uuid4()) for _ in xrange(2)]
+        Collection.put('%s/%s.ics' % (collection_uri, uuids[0]),
+            VTODO % uuids[0], 'text/calendar')
+        _, counts['put_new'] = count_queries(Collection.put,
+            '%s/%s.ics' % (collection_uri, uuids[1]), VTODO % uuids[1],
+            'text/calendar')
+
+        Collection.rm(uris[7])
+        cold()
+        _, counts['rm'] = count_queries(Collection.rm, uris[8])
+        return counts
+
+    def dav_request(self, method, path, body, version='HTTP/1.1'):
+        'Return the header lines and the body of the response to the request'
+        from pywebdav.lib.WebDAVServer import DAVRequestHandler
+        from trytond.modules.webdav.protocol import TrytonDAVInterface, \
+            LOCAL, setupConfig
+        dbname = Transaction().database.name
+        LOCAL.cache = {}
+
+        class Handler(DAVRequestHandler):
+            def __init__(self):
+                self._config = setupConfig()
+                self.IFACE_CLASS = TrytonDAVInterface('localhost', 8080)
+                self.IFACE_CLASS.baseurl = self._config.DAV.baseurl
+                self.command = method
+                self.path = '/%s/%s' % (urllib.quote(dbname), path)
+                self.request_version = self.protocol_version = version
+                self.headers = {
+                    'Content-Length': str(len(body)),
+                    'Depth': '1',
+                    }
+                self.rfile = StringIO(body)
+                self.wfile = StringIO()
+
+            def log_request(self, *args):
+                pass
+        handler = Handler()
+        getattr(handler, 'do_' + method)()
+        header, body = handler.wfile.getvalue().split('\r\n\r\n', 1)
+        return header.split('\r\n'), body
+
+    def process_propagations(self):
+        'Process the pending propagations like the worker'
+        Propagation = Pool().get('calendar.todo.propagation')
+        with Transaction().set_user(0):
+            for entry_id in Propagation.pending():
+                Propagation.process(entry_id)
+
+    @with_transaction()
+    def test_query_budgets(self):
+        'Test the queries of the CalDAV operations do not grow with todos'
+        counts = {}
+        for size in SIZES:
+            user, calendar = self.create_calendar('size%s' % size)
+            # The operations are run by the owner to apply its record rules
+            with Transaction().set_user(user.id):
+                todos = self.populate(calendar, size)
+                counts[size] = self.operations(calendar, todos)
+
+        smallest = counts[SIZES[0]]
+        for size in SIZES[1:]:
+            for operation, count in sorted(counts[size].iteritems()):
+                self.assertEqual(count, smallest[operation],
+                    msg='%s: %s queries for %s todos, %s for %s todos' % (
+                        operation, count, size, smallest[operation],
+                        SIZES[0]))
+        # The other backends are held to the largest budgets
+        budgets = QUERY_BUDGETS.get(backend.name(), {
+                o: max(b[o] for b in QUERY_BUDGETS.itervalues())
+                for o in smallest})
+        for operation, count in sorted(smallest.iteritems()):
+            self.assertLessEqual(count, budgets[operation],
+                msg='%s: %s queries over the budget of %s' % (
+                    operation, count, budgets[operation]))
+
+    @with_transaction()
+    def test_propagate_recurrence(self):
+        'Test the update of a recurring todo propagated to the attendees'
+        Todo = Pool().get('calendar.todo')
+
+        organizer, calendar = self.create_calendar('organizer')
+        attendee, attendee_calendar = self.create_calendar('attendee')
+        with Transaction().set_user(organizer.id):
+            todo, = Todo.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Weekly',
+                        'dtstart': datetime.datetime(2017, 1, 2, 9, 0),
+                        'organizer': organizer.email,
+                        'attendees': [('create', [{
+                                        'email': attendee.email,
+                                        }])],
+                        'rrules': [('create', [{
+                                        'freq': 'weekly',
+                                        'count': 10,
+                                        }])],
+                        'exdates': [('create', [{
+                                        'datetime': datetime.datetime(
+                                            2017, 1, 9, 9, 0),
+                                        }])],
+                        }])
+            for summary in ['Weekly meeting', 'Weekly review']:
+                Todo.write([todo], {
+                        'summary': summary,
+                        })
+
+        copy, = Todo.search([
+                ('calendar', '=', attendee_calendar.id),
+                ('uuid', '=', todo.uuid),
+                ])
+        todo = Todo(todo.id)
+        self.assertEqual(copy.summary, 'Weekly review')
+        for record in [todo, copy]:
+            self.assertEqual([r.freq for r in record.rrules], ['weekly'])
+            self.assertEqual([e.datetime for e in record.exdates],
+                [datetime.datetime(2017, 1, 9, 9, 0)])
+
+    @with_transaction()
+    def test_deferred_propagation(self):
+        'Test the queued propagation is run only by the worker'
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Attendee = pool.get('calendar.todo.attendee')
+        Propagation = pool.get('calendar.todo.propagation')
+
+        organizer, calendar = self.create_calendar('organizer')
+        attendee, attendee_calendar = self.create_calendar('attendee')
+        with set_config('calendar_todo', 'deferred_propagation', 'True'), \
+                Transaction().set_user(organizer.id):
+            todo, = Todo.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Deferred',
+                        'organizer': organizer.email,
+                        'attendees': [('create', [{
+                                        'email': attendee.email,
+                                        }])],
+                        }])
+
+        self.assertFalse(Todo.search([
+                    ('calendar', '=', attendee_calendar.id),
+                    ]))
+        self.assertTrue(Propagation.pending())
+        self.process_propagations()
+        copy, = Todo.search([
+                ('calendar', '=', attendee_calendar.id),
+                ('uuid', '=', todo.uuid),
+                ])
+        self.assertEqual(Propagation.pending(), [])
+
+        def attendees(todo):
+            return sorted((a.email, a.status) for a in Todo(todo.id).attendees)
+
+        before = attendees(copy)
+        with set_config('calendar_todo', 'deferred_propagation', 'True'), \
+                Transaction().set_user(organizer.id):
+            attendee_line, = todo.attendees
+            Attendee.write([attendee_line], {
+                    'status': 'accepted',
+                    })
+            Attendee.create([{
+                        'todo': todo.id,
+                        'email': 'other@calendar.example.com',
+                        }])
+        self.assertEqual(attendees(copy), before)
+        self.process_propagations()
+        self.assertEqual(attendees(copy), attendees(todo))
+
+        with set_config('calendar_todo', 'deferred_propagation', 'True'), \
+                Transaction().set_user(organizer.id):
+            Attendee.delete(Attendee.search([
+                        ('todo', '=', todo.id),
+                        ('email', '=', 'other@calendar.example.com'),
+                        ]))
+        self.assertEqual(len(Todo(copy.id).attendees), 2)
+        self.process_propagations()
+        self.assertEqual(attendees(copy), [(attendee.email, 'accepted')])
+
+        # The entry reset while it is processed is kept for the next run
+        with set_config('calendar_todo', 'deferred_propagation', 'True'), \
+                Transaction().set_user(organizer.id):
+            Todo.write([todo], {
+                    'summary': 'Deferred reset',
+                    })
+        entry_id, = Propagation.pending()
+        propagate_update = Todo._propagate_update
+
+        def _propagate_update(cls, todos):
+            propagate_update(todos)
+            Propagation.enqueue_update(todos)
+        with patch(Todo, '_propagate_update', classmethod(_propagate_update)):
+            self.process_propagations()
+        self.assertEqual(Propagation.pending(), [entry_id])
+        self.process_propagations()
+        self.assertEqual(Propagation.pending(), [])
+
+        with Transaction().set_user(attendee.id), \
+                Transaction().set_context(_check_access=True):
+            self.assertRaises(UserError, Propagation.create, [{
+                        'key': 'delete:0',
+                        'operation': 'delete',
+                        }])
+            self.assertRaises(UserError, Propagation.search, [])
+
+    @with_transaction()
+    def test_archived(self):
+        'Test the archived shared todos are still found by uuid'
+        from trytond.modules.calendar_todo.ical_import import import_todos
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Collection = pool.get('webdav.collection')
+
+        organizer, calendar = self.create_calendar('organizer')
+        attendee, attendee_calendar = self.create_calendar('attendee')
+        with Transaction().set_user(organizer.id):
+            todo, = Todo.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Archived',
+                        'status': 'completed',
+                        'completed': datetime.datetime(2016, 1, 4, 9, 0),
+                        'organizer': organizer.email,
+                        'attendees': [('create', [{
+                                        'email': attendee.email,
+                                        }])],
+                        }])
+            recurring_uuid = str(uuid.uuid4())
+            recurring, = Todo.create([{
+                        'calendar': calendar.id,
+                        'uuid': recurring_uuid,
+                        'summary': 'Archived recurring',
+                        'dtstart': datetime.datetime(2016, 1, 4, 9, 0),
+                        'status': 'completed',
+                        'completed': datetime.datetime(2016, 1, 4, 9, 0),
+                        'rrules': [('create', [{
+                                        'freq': 'weekly',
+                                        'count': 2,
+                                        }])],
+                        'occurences': [('create', [{
+                                        'calendar': calendar.id,
+                                        'uuid': recurring_uuid,
+                                        'recurrence': datetime.datetime(
+                                            2016, 1, 11, 9, 0),
+                                        'summary': 'Archived occurence',
+                                        }])],
+                        }])
+        self.assertEqual(Todo.archive(age=30), 3)
+        uuid_ = todo.uuid
+
+        def copies():
+            with Transaction().set_user(0), \
+                    Transaction().set_context(active_test=False):
+                return Todo.search([
+                        ('calendar', '=', attendee_calendar.id),
+                        ('uuid', '=', uuid_),
+                        ])
+
+        with Transaction().set_user(organizer.id), \
+                Transaction().set_context(active_test=False):
+            todo = Todo(todo.id)
+            Todo.write([todo], {
+                    'summary': 'Archived todo',
+                    })
+            copy, = copies()
+            self.assertEqual(copy.summary, 'Archived todo')
+            self.assertFalse(copy.active)
+
+            Todo.write([todo], {
+                    'active': True,
+                    })
+            self.assertEqual(len(copies()), 1)
+            Todo.write([todo], {
+                    'active': False,
+                    })
+
+            ical = vobject.readOne(Collection.get_data(
+                    'Calendars/%s/%s.ics' % (calendar.name, todo.uuid)))
+            created, skipped = next(import_todos(calendar.id,
+                    [Todo.ical2plain(ical)]))
+            self.assertEqual((created, skipped), (0, 1))
+
+            dbname = Transaction().database.name
+            filter = xml.dom.minidom.parseString(
+                '<C:calendar-multiget xmlns:D="DAV:" '
+                'xmlns:C="urn:ietf:params:xml:ns:caldav">'
+                '<D:prop><D:getetag/></D:prop>'
+                '<D:href>/%s/Calendars/%s/%s.ics</D:href>'
+                '</C:calendar-multiget>' % (dbname, calendar.name, todo.uuid)
+                ).documentElement
+            self.assertEqual(list(Collection.get_childs(
+                        'Calendars/%s' % calendar.name, filter=filter)),
+                ['%s.ics' % todo.uuid])
+            self.assertEqual(list(Collection.get_childs(
+                        'Calendars/%s' % calendar.name)), [])
+
+            # The multiget reads the archived occurences like GET
+            path = 'Calendars/%s/%s.ics' % (calendar.name, recurring.uuid)
+            filter = xml.dom.minidom.parseString(
+                '<C:calendar-multiget xmlns:D="DAV:" '
+                'xmlns:C="urn:ietf:params:xml:ns:caldav">'
+                '<D:prop><C:calendar-data/></D:prop>'
+                '<D:href>/%s/%s</D:href>'
+                '</C:calendar-multiget>' % (dbname, path)
+                ).documentElement
+            with Transaction().set_context(active_test=True):
+                cache = {}
+                self.assertEqual(list(Collection.get_childs(
+                            'Calendars/%s' % calendar.name, filter=filter,
+                            cache=cache)),
+                    ['%s.ics' % recurring.uuid])
+                for data in [Collection.get_data(path, cache=cache),
+                        Collection.get_data(path)]:
+                    ical = vobject.readOne(data)
+                    self.assertEqual(len(ical.vtodo_list), 2)
+
+            Todo.delete([todo])
+            self.assertEqual(copies(), [])
+
+    @with_transaction()
+    def test_todo_cache_sharing(self):
+        'Test the cached todo lookups follow the sharing of the calendar'
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Calendar = pool.get('calendar.calendar')
+        ReadUser = pool.get('calendar.calendar-read-res.user')
+        Collection = pool.get('webdav.collection')
+
+        owner, calendar = self.create_calendar('owner')
+        reader, _ = self.create_calendar('reader')
+        Calendar.write([calendar], {
+                'read_users': [('add', [reader.id])],
+                })
+        with Transaction().set_user(owner.id):
+            todo, = Todo.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Shared',
+                        }])
+        uri = 'Calendars/%s/%s.ics' % (calendar.name, todo.uuid)
+
+        with Transaction().set_user(reader.id):
+            self.assertEqual(Collection.exists(uri), 1)
+        ReadUser.delete(ReadUser.search([
+                    ('calendar', '=', calendar.id),
+                    ('user', '=', reader.id),
+                    ]))
+        with Transaction().set_user(reader.id):
+            self.assertNotEqual(Collection.exists(uri), 1)
+        with Transaction().set_user(owner.id):
+            self.assertEqual(Collection.exists(uri), 1)
+
+    @with_transaction()
+    def test_put_occurence_changed(self):
+        'Test the put is not skipped after a change of the occurences'
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Collection = pool.get('webdav.collection')
+
+        owner, calendar = self.create_calendar('owner')
+        uuid_ = str(uuid.uuid4())
+        uri = 'Calendars/%s/%s.ics' % (calendar.name, uuid_)
+        data = RECURRING % {'uuid': uuid_}
+
+        def occurences():
+            todo, = Todo.search([
+                    ('calendar', '=', calendar.id),
+                    ('uuid', '=', uuid_),
+                    ('parent', '=', None),
+                    ])
+            return [(o.recurrence, o.status) for o in todo.occurences]
+
+        with Transaction().set_user(owner.id):
+            Collection.put(uri, data, 'text/calendar')
+            expected = occurences()
+            self.assertEqual(len(expected), 1)
+            todo = Todo(Collection.todo(uri))
+            occurence, = todo.occurences
+
+            Todo.set_status([occurence], 'completed')
+            Collection.put(uri, data, 'text/calendar')
+            self.assertEqual(occurences(), expected)
+
+            Todo.delete([occurence])
+            Collection.put(uri, data, 'text/calendar')
+            self.assertEqual(occurences(), expected)
+
+            Todo.create([{
+                        'calendar': calendar.id,
+                        'uuid': uuid_,
+                        'parent': todo.id,
+                        'recurrence': datetime.datetime(2017, 1, 16, 9, 0),
+                        'summary': 'Weekly added',
+                        }])
+            Collection.put(uri, data, 'text/calendar')
+            self.assertEqual(occurences(), expected)
+
+    @with_transaction()
+    def test_put_read_only(self):
+        'Test the put of an unchanged todo is forbidden to the readers'
+        from pywebdav.lib.errors import DAV_Forbidden
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        Collection = pool.get('webdav.collection')
+
+        owner, calendar = self.create_calendar('owner')
+        reader, _ = self.create_calendar('reader')
+        Calendar.write([calendar], {
+                'read_users': [('add', [reader.id])],
+                })
+        uuid_ = str(uuid.uuid4())
+        uri = 'Calendars/%s/%s.ics' % (calendar.name, uuid_)
+        data = RECURRING % {'uuid': uuid_}
+
+        with Transaction().set_user(owner.id), \
+                Transaction().set_context(_check_access=True):
+            Collection.put(uri, data, 'text/calendar')
+            Collection.put(uri, data, 'text/calendar')
+        with Transaction().set_user(reader.id), \
+                Transaction().set_context(_check_access=True):
+            self.assertEqual(Collection.exists(uri), 1)
+            self.assertRaises(DAV_Forbidden, Collection.put, uri, data,
+                'text/calendar')
+
+    @with_transaction()
+    def test_put_changes(self):
+        'Test the put of a todo with changed attendees and occurences'
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Collection = pool.get('webdav.collection')
+
+        owner, calendar = self.create_calendar('owner')
+        uuid_ = str(uuid.uuid4())
+        uri = 'Calendars/%s/%s.ics' % (calendar.name, uuid_)
+        data = ('BEGIN:VCALENDAR\nVERSION:2.0\n'
+            'PRODID:-//Tryton//calendar_todo test//EN\n'
+            'BEGIN:VTODO\nUID:%(uuid)s\nDTSTAMP:20170102T090000Z\n'
+            'SUMMARY:Weekly\nDTSTART:20170102T090000Z\n'
+            'RRULE:FREQ=WEEKLY;COUNT=10\n'
+            'ORGANIZER:MAILTO:owner@calendar.example.com\n'
+            'ATTENDEE;PARTSTAT=%(partstat)s:MAILTO:guest@example.com\n'
+            'END:VTODO\n'
+            'BEGIN:VTODO\nUID:%(uuid)s\nRECURRENCE-ID:20170109T090000Z\n'
+            'DTSTAMP:20170102T090000Z\nSUMMARY:%(summary)s\n'
+            'DTSTART:20170110T090000Z\nEND:VTODO\nEND:VCALENDAR\n')
+
+        with Transaction().set_user(owner.id):
+            Collection.put(uri, data % {
+                    'uuid': uuid_,
+                    'partstat': 'NEEDS-ACTION',
+                    'summary': 'Weekly moved',
+                    }, 'text/calendar')
+            Collection.put(uri, data % {
+                    'uuid': uuid_,
+                    'partstat': 'ACCEPTED',
+                    'summary': 'Weekly moved again',
+                    }, 'text/calendar')
+            todo = Todo(Collection.todo(uri))
+            attendee, = todo.attendees
+            self.assertEqual(attendee.status, 'accepted')
+            occurence, = todo.occurences
+            self.assertEqual(occurence.summary, 'Weekly moved again')
+
+    @with_transaction()
+    def test_search_text(self):
+        'Test the full-text search of todos'
+        Todo = Pool().get('calendar.todo')
+        cursor = Transaction().connection.cursor()
+
+        owner, calendar = self.create_calendar('owner')
+        other, other_calendar = self.create_calendar('other')
+        review, budget, shopping = Todo.create([{
+                    'calendar': calendar.id,
+                    'uuid': str(uuid.uuid4()),
+                    'summary': 'Review the quarterly report',
+                    'description': 'Check the figures of the budget',
+                    }, {
+                    'calendar': calendar.id,
+                    'uuid': str(uuid.uuid4()),
+                    'summary': 'Prepare the budget',
+                    }, {
+                    'calendar': calendar.id,
+                    'uuid': str(uuid.uuid4()),
+                    'summary': 'Shopping',
+                    'description': 'Buy milk',
+                    }])
+        hidden, = Todo.create([{
+                    'calendar': other_calendar.id,
+                    'summary': 'Hidden budget',
+                    }])
+
+        if backend.name() == 'postgresql':
+            cursor.execute('SELECT indexdef FROM pg_indexes '
+                'WHERE indexname = %s', (Todo._table + '_fulltext_index',))
+            indexdef, = cursor.fetchone()
+            self.assertIn('gin', indexdef)
+            self.assertIn('to_tsvector', indexdef)
+        elif backend.name() == 'sqlite':
+            self.assertTrue(Todo._fulltext_sqlite())
+
+        def fts_ids(word):
+            'Return the ids indexed by the SQLite full-text table'
+            cursor.execute('SELECT rowid FROM "%s_fts" WHERE "%s_fts" '
+                'MATCH ? ORDER BY rowid' % (Todo._table, Todo._table),
+                (word,))
+            return [i for i, in cursor.fetchall()]
+
+        def fallback(text, **kwargs):
+            'Search the text with the ilike fallback'
+            with patch(backend, 'name', lambda: None):
+                return Todo.search_text(text, **kwargs)
+
+        for search_text in [Todo.search_text, fallback]:
+            with Transaction().set_user(owner.id):
+                # The record rules hide the todos of the other calendar
+                self.assertEqual(search_text('budget'), [budget, review])
+                self.assertEqual(search_text('quarterly'), [review])
+                self.assertEqual(search_text('figures budget'), [review])
+                self.assertEqual(search_text('milk'), [shopping])
+                self.assertEqual(search_text('budget', limit=1), [budget])
+                self.assertEqual(search_text('budget',
+                        domain=[('summary', 'like', 'Review%')]), [review])
+                self.assertEqual(search_text(' '), [])
+            with Transaction().set_user(other.id):
+                self.assertEqual(search_text('budget'), [hidden])
+
+        # The updates and deletions reach the index
+        Todo.write([shopping], {
+                'summary': 'Groceries',
+                'description': 'Buy bread',
+                })
+        Todo.delete([hidden])
+        if backend.name() == 'sqlite' and Todo._fulltext_sqlite():
+            self.assertEqual(fts_ids('milk'), [])
+            self.assertEqual(fts_ids('bread'), [shopping.id])
+            self.assertEqual(fts_ids('hidden'), [])
+        for search_text in [Todo.search_text, fallback]:
+            self.assertEqual(search_text('milk'), [])
+            self.assertEqual(search_text('groceries bread'), [shopping])
+            self.assertEqual(search_text('hidden'), [])
+
+    @with_transaction()
+    def test_check_recurrences(self):
+        'Test the occurences can not be recurrent'
+        Todo = Pool().get('calendar.todo')
+
+        owner, calendar = self.create_calendar('owner')
+        uuid_ = str(uuid.uuid4())
+        todo, = Todo.create([{
+                    'calendar': calendar.id,
+                    'uuid': uuid_,
+                    'summary': 'Weekly',
+                    'dtstart': datetime.datetime(2017, 1, 2, 9, 0),
+                    'rrules': [('create', [{
+                                    'freq': 'weekly',
+                                    }])],
+                    'occurences': [('create', [{
+                                    'calendar': calendar.id,
+                                    'uuid': uuid_,
+                                    'recurrence': datetime.datetime(
+                                        2017, 1, 9, 9, 0),
+                                    'summary': 'Weekly moved',
+                                    }])],
+                    }])
+        occurence, = todo.occurences
+
+        with self.assertRaises(UserError) as cm:
+            Todo.write([occurence], {
+                    'rrules': [('create', [{
+                                    'freq': 'daily',
+                                    }])],
+                    })
+        self.assertIn('can not be recurrent', cm.exception.message)
+
+    @with_transaction()
+    def test_set_status(self):
+        'Test set status'
+        Todo = Pool().get('calendar.todo')
+
+        owner, calendar = self.create_calendar('owner')
+        with Transaction().set_user(owner.id):
+            todo, = Todo.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Status',
+                        }])
+            self.assertRaises(UserError, Todo.set_status, [todo], 'unknown')
+            Todo.set_status([todo], 'completed')
+            values, = Todo.read([todo.id],
+                ['status', 'percent_complete', 'completed'])
+            self.assertEqual(values['status'], 'completed')
+            self.assertEqual(values['percent_complete'], 100)
+            self.assertEqual(values['completed'].microsecond, 0)
+            # The completed date is valid for the next write
+            Todo.write([todo], {
+                    'summary': 'Status completed',
+                    })
+
+    @with_transaction()
+    def test_propagate_existing_uuid(self):
+        'Test propagate to a calendar which has already the uuid'
+        Todo = Pool().get('calendar.todo')
+
+        organizer, calendar = self.create_calendar('organizer')
+        attendee, attendee_calendar = self.create_calendar('attendee')
+        uuid_ = str(uuid.uuid4())
+        with Transaction().set_user(attendee.id):
+            Todo.create([{
+                        'calendar': attendee_calendar.id,
+                        'summary': 'Imported',
+                        'uuid': uuid_,
+                        }])
+        with Transaction().set_user(organizer.id):
+            Todo.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Shared',
+                        'uuid': uuid_,
+                        'organizer': organizer.email,
+                        'attendees': [('create', [{
+                                        'email': attendee.email,
+                                        }])],
+                        }])
+        with Transaction().set_user(0):
+            todos = Todo.search([
+                    ('calendar', '=', attendee_calendar.id),
+                    ('uuid', '=', uuid_),
+                    ])
+        self.assertEqual(sorted(t.summary for t in todos),
+            ['Imported', 'Shared'])
+
+    @with_transaction()
+    def test_changed_since(self):
+        'Test changed since with deleted and archived todos'
+        Todo = Pool().get('calendar.todo')
+
+        owner, calendar = self.create_calendar('owner')
+        other, other_calendar = self.create_calendar('other')
+        archived, deleted, kept = Todo.create([{
+                    'calendar': calendar.id,
+                    'summary': 'Archived',
+                    'status': 'completed',
+                    'completed': datetime.datetime(2016, 1, 4, 9, 0),
+                    }, {
+                    'calendar': calendar.id,
+                    'summary': 'Deleted',
+                    }, {
+                    'calendar': calendar.id,
+                    'summary': 'Kept',
+                    }])
+        other_todo, = Todo.create([{
+                    'calendar': other_calendar.id,
+                    'summary': 'Other',
+                    }])
+        domain = [('calendar', '=', calendar.id)]
+
+        changes = Todo.changed_since(domain=domain)
+        self.assertEqual(sorted(i for i, _ in changes['changed']),
+            sorted([archived.id, deleted.id, kept.id]))
+        self.assertEqual(changes['deleted'], [])
+
+        self.assertEqual(Todo.archive(age=30), 1)
+        Todo.delete([deleted, other_todo])
+        changes = Todo.changed_since(changes['cursor'], domain=domain)
+        self.assertEqual([i for i, _ in changes['changed']], [kept.id])
+        self.assertEqual(sorted(changes['deleted']),
+            sorted([archived.id, deleted.id]))
+
+        changes = Todo.changed_since(changes['cursor'], domain=['OR',
+                ('calendar', '=', other_calendar.id),
+                ('summary', '=', 'Kept'),
+                ])
+        self.assertEqual(sorted(changes['deleted']),
+            sorted([archived.id, deleted.id, other_todo.id]))
+
+    @with_transaction()
+    def test_tombstone_clean(self):
+        'Test the scheduled action cleaning the old tombstones'
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Tombstone = pool.get('calendar.todo.tombstone')
+        Cron = pool.get('ir.cron')
+        ModelData = pool.get('ir.model.data')
+        table = Tombstone.__table__()
+        cursor = Transaction().connection.cursor()
+
+        owner, calendar = self.create_calendar('owner')
+        old, recent = Todo.create([{
+                    'calendar': calendar.id,
+                    'summary': 'Old',
+                    'uuid': str(uuid.uuid4()),
+                    }, {
+                    'calendar': calendar.id,
+                    'summary': 'Recent',
+                    'uuid': str(uuid.uuid4()),
+                    }])
+        old_id, recent_id = old.id, recent.id
+        Todo.delete([old, recent])
+        cursor.execute(*table.update(
+                columns=[table.create_date],
+                values=[datetime.datetime.now() - datetime.timedelta(days=40)],
+                where=table.todo == old_id))
+
+        cron = Cron(ModelData.get_id('calendar_todo', 'cron_tombstone_clean'))
+        cron.run_once()
+        self.assertEqual(len(Tombstone.search([])), 2)
+        with set_config('calendar_todo', 'tombstone_age', '30'):
+            cron.run_once()
+        self.assertEqual([t.todo for t in Tombstone.search([])],
+            [recent_id])
+
+    @with_transaction()
+    def test_get_childs(self):
+        'Test get childs of a calendar'
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Collection = pool.get('webdav.collection')
+
+        owner, calendar = self.create_calendar('owner')
+        todos = Todo.create([{
+                    'calendar': calendar.id,
+                    'summary': 'Todo %s' % i,
+                    'uuid': str(uuid.uuid4()),
+                    } for i in range(3)])
+        collection_uri = 'Calendars/%s' % calendar.name
+        cache = {}
+
+        childs = Collection.get_childs(collection_uri, cache=cache)
+        self.assertIsInstance(childs, list)
+        self.assertEqual(sorted(childs),
+            sorted('%s.ics' % t.uuid for t in todos))
+        self.assertEqual(sorted(cache['_calendar']['calendar.todo']),
+            sorted(t.id for t in todos))
+        self.assertEqual(
+            list(Collection.iter_childs(collection_uri)), childs)
+
+    @with_transaction()
+    def test_iter_childs_cache(self):
+        'Test the cache stays bounded while streaming the todo childs'
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Collection = pool.get('webdav.collection')
+        database = Transaction().database
+
+        owner, calendar = self.create_calendar('owner')
+        Todo.create([{
+                    'calendar': calendar.id,
+                    'summary': 'Todo %s' % i,
+                    'uuid': str(uuid.uuid4()),
+                    } for i in range(50)])
+        collection_uri = 'Calendars/%s' % calendar.name
+        cache = {}
+
+        sizes = []
+        with patch(database, 'IN_MAX', 10):
+            for child in Collection.iter_childs(collection_uri, cache=cache):
+                uri = '%s/%s' % (collection_uri, child)
+                Collection.get_creationdate(uri, cache=cache)
+                Collection.get_lastmodified(uri, cache=cache)
+                Collection.get_etag(uri, cache=cache)
+                sizes.append(len(cache['_calendar']['calendar.todo']))
+        self.assertEqual(len(sizes), 50)
+        self.assertEqual(max(sizes), 10)
+        self.assertEqual(cache['_calendar']['calendar.todo'], {})
+
+    @with_transaction()
+    def test_multistatus_stream(self):
+        'Test the multistatus responses are sent by chunks'
+        Todo = Pool().get('calendar.todo')
+        dbname = Transaction().database.name
+
+        owner, calendar = self.create_calendar('owner')
+        todos = Todo.create([{
+                    'calendar': calendar.id,
+                    'summary': 'Todo %s' % i,
+                    'uuid': str(uuid.uuid4()),
+                    } for i in range(3)])
+
+        def dechunk(body):
+            chunks = []
+            while True:
+                size, body = body.split('\r\n', 1)
+                size = int(size, 16)
+                if not size:
+                    self.assertEqual(body, '\r\n')
+                    return ''.join(chunks)
+                chunks.append(body[:size])
+                body = body[size + 2:]
+
+        def responses(body):
+            return xml.dom.minidom.parseString(body).getElementsByTagName(
+                'D:response')
+
+        propfind = ('<?xml version="1.0" encoding="utf-8"?>'
+            '<D:propfind xmlns:D="DAV:"><D:prop><D:getetag/></D:prop>'
+            '</D:propfind>')
+        header, body = self.dav_request('PROPFIND', 'Calendars/owner',
+            propfind)
+        self.assertIn('Transfer-Encoding: chunked', header)
+        body = dechunk(body)
+        self.assertEqual(len(responses(body)), 4)
+
+        header, plain_body = self.dav_request('PROPFIND', 'Calendars/owner',
+            propfind, version='HTTP/1.0')
+        self.assertNotIn('Transfer-Encoding: chunked', header)
+        self.assertIn('Connection: close', header)
+        self.assertEqual(plain_body, body)
+
+        multiget = ('<?xml version="1.0" encoding="utf-8"?>'
+            '<C:calendar-multiget xmlns:D="DAV:" '
+            'xmlns:C="urn:ietf:params:xml:ns:caldav">'
+            '<D:prop><D:getetag/><C:calendar-data/></D:prop>'
+            + ''.join('<D:href>/%s/Calendars/owner/%s.ics</D:href>'
+                % (dbname, t.uuid) for t in todos[:2])
+            + '</C:calendar-multiget>')
+        header, body = self.dav_request('REPORT', 'Calendars/owner',
+            multiget)
+        self.assertIn('Transfer-Encoding: chunked', header)
+        self.assertEqual(len(responses(dechunk(body))), 2)
+
+    @with_transaction()
+    def test_multistatus_error(self):
+        'Test the errors while streaming the multistatus responses'
+        from pywebdav.lib.errors import DAV_Forbidden
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Collection = pool.get('webdav.collection')
+
+        owner, calendar = self.create_calendar('owner')
+        Todo.create([{
+                    'calendar': calendar.id,
+                    'summary': 'Todo %s' % i,
+                    'uuid': str(uuid.uuid4()),
+                    } for i in range(3)])
+        todo_childs = Collection._todo_childs
+
+        def failing(exception, count):
+            'Return the todo childs raising the exception after count childs'
+            def _todo_childs(cls, query, cache=None, evict=False):
+                for i, child in enumerate(todo_childs(query, cache=cache,
+                            evict=evict)):
+                    if i >= count:
+                        break
+                    yield child
+                raise exception
+            return classmethod(_todo_childs)
+
+        propfind = ('<?xml version="1.0" encoding="utf-8"?>'
+            '<D:propfind xmlns:D="DAV:"><D:prop><D:getetag/></D:prop>'
+            '</D:propfind>')
+        for exception, status in [
+                (DAV_Forbidden(), 'HTTP/1.1 403 Forbidden'),
+                (Exception('database'), 'HTTP/1.1 500 Internal Server Error'),
+                ]:
+            with patch(Collection, '_todo_childs', failing(exception, 0)):
+                header, body = self.dav_request('PROPFIND',
+                    'Calendars/owner', propfind)
+            self.assertEqual(header[0], status)
+            self.assertNotIn('Transfer-Encoding: chunked', header)
+
+        # The error after the status stops the body before its last chunk
+        with patch(Collection, '_todo_childs',
+                failing(Exception('database'), 2)):
+            header, body = self.dav_request('PROPFIND', 'Calendars/owner',
+                propfind)
+        self.assertEqual(header[0], 'HTTP/1.1 207 Multi-Status')
+        self.assertIn('Transfer-Encoding: chunked', header)
+        self.assertEqual(body.count('<D:response'), 3)
+        self.assertFalse(body.endswith('0\r\n\r\n'))
+        self.assertNotIn('</D:multistatus>', body)
+
+    @with_transaction()
+    def test_statistics(self):
+        'Test the statistics of the calendars'
+        Todo = Pool().get('calendar.todo')
+
+        owner, calendar = self.create_calendar('owner')
+        other, other_calendar = self.create_calendar('other')
+        done, pending, _, archived = Todo.create([{
+                    'calendar': calendar.id,
+                    'summary': 'Done',
+                    'status': 'completed',
+                    'percent_complete': 100,
+                    'completed': datetime.datetime.now().replace(
+                        microsecond=0),
+                    }, {
+                    'calendar': calendar.id,
+                    'summary': 'Pending',
+                    'status': 'needs-action',
+                    'due': datetime.datetime(2016, 1, 4, 9, 0),
+                    }, {
+                    'calendar': calendar.id,
+                    'summary': 'In process',
+                    'status': 'in-process',
+                    'percent_complete': 50,
+                    }, {
+                    'calendar': calendar.id,
+                    'summary': 'Archived',
+                    'status': 'cancelled',
+                    'completed': datetime.datetime(2016, 1, 4, 9, 0),
+                    }])
+        Todo.create([{
+                    'calendar': other_calendar.id,
+                    'summary': 'Other',
+                    }])
+        self.assertEqual(Todo.archive(age=30), 1)
+
+        statistics, other_statistics = Todo.get_statistics(
+            [calendar.id, other_calendar.id])
+        self.assertEqual(statistics['id'], calendar.id)
+        self.assertEqual(statistics['count'], 3)
+        self.assertEqual(statistics['status'], {
+                'completed': 1,
+                'needs-action': 1,
+                'in-process': 1,
+                })
+        self.assertEqual(statistics['percent_complete'], 50)
+        self.assertEqual(statistics['overdue'], 1)
+        self.assertEqual(other_statistics['count'], 1)
+
+        Todo.set_status([pending], 'completed')
+        Todo.write([done], {
+                'percent_complete': 90,
+                })
+        statistics, = Todo.get_statistics([calendar.id])
+        self.assertEqual(statistics['status'], {
+                'completed': 2,
+                'in-process': 1,
+                })
+        self.assertEqual(statistics['percent_complete'], 80)
+        self.assertEqual(statistics['overdue'], 0)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -1,30 +1,69 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import uuid
+import json
+import hashlib
+import logging
 import vobject
 import dateutil.tz
 import pytz
 import datetime
 import xml.dom.minidom
-from sql import Table, Column
-
-from trytond.model import ModelSQL, ModelView, fields, Unique
-from trytond.tools import reduce_ids
+from itertools import chain
+from sql import Table, Column, Null, Literal
+from sql.aggregate import Count, Sum, Min
+from sql.conditionals import Case, Coalesce
+from sql.functions import Function, CurrentTimestamp
+from sql.operators import BinaryOperator, Concat, Exists
+
+from trytond.model import Model, ModelSQL, ModelView, fields, Unique
+from trytond.tools import reduce_ids, grouped_slice
 from trytond import backend
 from trytond.pyson import Eval, If, Bool, PYSONEncoder
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.rpc import RPC
 from trytond.modules.calendar import AlarmMixin, DateMixin, RRuleMixin, \
     AttendeeMixin
 
+from .instrument import measured
+
 __all__ = ['Todo', 'TodoCategory', 'TodoRDate', 'TodoRRule', 'TodoExDate',
-    'TodoExRule', 'TodoAttendee', 'TodoAlarm']
+    'TodoExRule', 'TodoAttendee', 'TodoAlarm', 'TodoTombstone']
+
+logger = logging.getLogger(__name__)
 
 tzlocal = dateutil.tz.tzlocal()
 tzutc = dateutil.tz.tzutc()
 
 domimpl = xml.dom.minidom.getDOMImplementation()
 
+FULLTEXT_CONFIGURATION = 'simple'
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+STATISTICS_CACHES = 16
+
+
+class ToTsvector(Function):
+    __slots__ = ()
+    _function = 'TO_TSVECTOR'
+
+
+class PlainToTsquery(Function):
+    __slots__ = ()
+    _function = 'PLAINTO_TSQUERY'
+
+
+class TsRank(Function):
+    __slots__ = ()
+    _function = 'TS_RANK'
+
+
+class Match(BinaryOperator):
+    __slots__ = ()
+    _operator = '@@'
+
 
 class Todo(ModelSQL, ModelView):
     "Todo"
@@ -108,6 +147,14 @@ class Todo(ModelSQL, ModelView):
                 'invisible': Bool(Eval('parent')),
             }, depends=['parent'])
     vtodo = fields.Binary('vtodo')
+    active = fields.Boolean('Active', select=True,
+        help='Uncheck to archive the todo.')
+    ical_hash = fields.Char('iCalendar Hash', readonly=True,
+        help='The hash of the last iCalendar put unchanged since.')
+    # The statistics are spread over a fixed number of caches by calendar
+    _statistics_caches = tuple(
+        Cache('calendar_todo.statistics.%s' % i, context=False)
+        for i in range(STATISTICS_CACHES))
 
     @classmethod
     def __setup__(cls):
@@ -121,6 +168,13 @@ class Todo(ModelSQL, ModelView):
             ]
         cls._error_messages.update({
                 'invalid_recurrence': 'Todo "%s" can not be recurrent.',
+                'invalid_status': 'Status "%s" is not valid for todos.',
+                })
+        cls.__rpc__.update({
+                'get_statistics': RPC(),
+                'search_text': RPC(result=lambda r: map(int, r)),
+                'set_status': RPC(readonly=False, instantiate=0),
+                'changed_since': RPC(),
                 })
 
     @classmethod
@@ -139,6 +193,163 @@ class Todo(ModelSQL, ModelView):
                 Rule.delete([Rule(model_data.db_id)])
         super(Todo, cls).__register__(module_name)
 
+        cls._register_master_index(module_name)
+        cls._register_fulltext(module_name)
+
+    @classmethod
+    def _register_master_index(cls, module_name):
+        '''
+        Create the index on calendar and uuid of the master todos used by
+        the CalDAV lookups
+        '''
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        index_name = cls._table + '_master_uuid_index'
+
+        if backend.name() == 'postgresql':
+            indexes = Table('pg_indexes')
+            cursor.execute(*indexes.select(indexes.indexdef,
+                    where=indexes.indexname == index_name))
+        elif backend.name() == 'sqlite':
+            indexes = Table('sqlite_master')
+            cursor.execute(*indexes.select(indexes.sql,
+                    where=(indexes.type == 'index')
+                    & (indexes.name == index_name)))
+        else:
+            # No partial index
+            TableHandler(cls, module_name).index_action(
+                ['calendar', 'uuid'], 'add')
+            return
+        row = cursor.fetchone()
+        if row:
+            # Migration from the unique index which prevents the copies of
+            # the attendees when their calendar already has the uuid
+            if 'UNIQUE' not in row[0].upper():
+                return
+            cursor.execute('DROP INDEX "%s"' % index_name)
+        cursor.execute('CREATE INDEX "%s" ON "%s" ("calendar", "uuid") '
+            'WHERE "parent" IS NULL' % (index_name, cls._table))
+
+    @classmethod
+    def _fulltext_document(cls, table):
+        'Return the SQL expression of the text indexed for the todo'
+        return Concat(Concat(Coalesce(table.summary, ''), ' '),
+            Coalesce(table.description, ''))
+
+    @classmethod
+    def _register_fulltext(cls, module_name):
+        '''
+        Create the full-text index on summary and description:
+        a GIN index of tsvector on PostgreSQL and a FTS5 table maintained by
+        triggers on SQLite
+        '''
+        cursor = Transaction().connection.cursor()
+
+        if backend.name() == 'postgresql':
+            index_name = cls._table + '_fulltext_index'
+            indexes = Table('pg_indexes')
+            cursor.execute(*indexes.select(indexes.indexname,
+                    where=indexes.indexname == index_name))
+            if cursor.fetchone():
+                return
+            cursor.execute('CREATE INDEX "%s" ON "%s" USING GIN ('
+                'TO_TSVECTOR(\'%s\', COALESCE("summary", \'\') || \' \' '
+                '|| COALESCE("description", \'\')))'
+                % (index_name, cls._table, FULLTEXT_CONFIGURATION))
+        elif backend.name() == 'sqlite':
+            fts_name = cls._table + '_fts'
+            master = Table('sqlite_master')
+            cursor.execute(*master.select(master.name,
+                    where=(master.type == 'table')
+                    & (master.name == fts_name)))
+            if cursor.fetchone():
+                return
+            try:
+                cursor.execute('CREATE VIRTUAL TABLE "%s" USING fts5('
+                    'summary, description, content="%s", '
+                    'content_rowid="id")' % (fts_name, cls._table))
+            except Exception:
+                logger.warning('SQLite without FTS5, '
+                    'the full-text search of todos is not indexed')
+                return
+            cursor.execute('CREATE TRIGGER "%(fts)s_insert" AFTER INSERT '
+                'ON "%(table)s" BEGIN '
+                'INSERT INTO "%(fts)s" (rowid, summary, description) '
+                'VALUES (new.id, new.summary, new.description); END'
+                % {'fts': fts_name, 'table': cls._table})
+            cursor.execute('CREATE TRIGGER "%(fts)s_delete" AFTER DELETE '
+                'ON "%(table)s" BEGIN '
+                'INSERT INTO "%(fts)s" ("%(fts)s", rowid, summary, '
+                'description) VALUES '
+                '(\'delete\', old.id, old.summary, old.description); END'
+                % {'fts': fts_name, 'table': cls._table})
+            cursor.execute('CREATE TRIGGER "%(fts)s_update" AFTER UPDATE '
+                'OF summary, description ON "%(table)s" BEGIN '
+                'INSERT INTO "%(fts)s" ("%(fts)s", rowid, summary, '
+                'description) VALUES '
+                '(\'delete\', old.id, old.summary, old.description); '
+                'INSERT INTO "%(fts)s" (rowid, summary, description) '
+                'VALUES (new.id, new.summary, new.description); END'
+                % {'fts': fts_name, 'table': cls._table})
+            cursor.execute('INSERT INTO "%s" ("%s") VALUES (\'rebuild\')'
+                % (fts_name, fts_name))
+
+    @classmethod
+    def _fulltext_sqlite(cls):
+        'Test if the SQLite full-text table exists'
+        cursor = Transaction().connection.cursor()
+        master = Table('sqlite_master')
+        cursor.execute(*master.select(master.name,
+                where=(master.type == 'table')
+                & (master.name == cls._table + '_fts')))
+        return bool(cursor.fetchone())
+
+    @classmethod
+    def search_text(cls, text, domain=None, offset=0, limit=None):
+        '''
+        Return the todos matching all the words of text in their summary or
+        description ordered by relevance. The domain restricts the todos
+        searched and the record rules are applied.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        words = text.split()
+        if not words:
+            return []
+        query = cls.search(domain or [], order=[], query=True)
+
+        if backend.name() == 'postgresql':
+            document = ToTsvector(FULLTEXT_CONFIGURATION,
+                cls._fulltext_document(table))
+            tsquery = PlainToTsquery(FULLTEXT_CONFIGURATION, text)
+            cursor.execute(*table.select(table.id,
+                    where=table.id.in_(query) & Match(document, tsquery),
+                    order_by=[TsRank(document, tsquery).desc, table.id.desc],
+                    offset=offset or None, limit=limit))
+        elif backend.name() == 'sqlite' and cls._fulltext_sqlite():
+            fts_name = cls._table + '_fts'
+            match = ' '.join('"%s"' % w.replace('"', '""') for w in words)
+            sub_query, params = tuple(query)
+            sql = ('SELECT rowid FROM "%s" WHERE "%s" MATCH ? '
+                'AND rowid IN (%s) ORDER BY rank, rowid DESC'
+                % (fts_name, fts_name, sub_query))
+            params = (match,) + tuple(params)
+            if limit is not None or offset:
+                sql += ' LIMIT ? OFFSET ?'
+                params += (limit if limit is not None else -1, offset or 0)
+            cursor.execute(sql, params)
+        else:
+            where = table.id.in_(query)
+            for word in words:
+                pattern = '%' + word + '%'
+                where &= (table.summary.ilike(pattern)
+                    | table.description.ilike(pattern))
+            cursor.execute(*table.select(table.id, where=where,
+                    order_by=table.id.desc,
+                    offset=offset or None, limit=limit))
+        return cls.browse([r[0] for r in cursor.fetchall()])
+
     @staticmethod
     def default_uuid():
         return str(uuid.uuid4())
@@ -155,6 +366,10 @@ class Todo(ModelSQL, ModelView):
     def default_percent_complete():
         return 0
 
+    @staticmethod
+    def default_active():
+        return True
+
     @fields.depends('status', 'completed', 'percent_complete')
     def on_change_status(self):
         if not self.status:
@@ -171,21 +386,36 @@ class Todo(ModelSQL, ModelView):
     @classmethod
     def validate(cls, todos):
         super(Todo, cls).validate(todos)
-        for todo in todos:
-            todo.check_recurrence()
+        cls.check_recurrences(todos)
 
-    def check_recurrence(self):
+    @classmethod
+    def check_recurrences(cls, todos):
         '''
-        Check the recurrence is not recurrent.
+        Check the recurrences are not recurrent with one query per slice
         '''
-        if not self.parent:
-            return True
-        if (self.rdates
-                or self.rrules
-                or self.exdates
-                or self.exrules
-                or self.occurences):
-            self.raise_user_error('invalid_recurrence', (self.rec_name,))
+        pool = Pool()
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        occurence = cls.__table__()
+        recurrent = Exists(occurence.select(Literal(1),
+                where=occurence.parent == table.id))
+        for name in ['calendar.todo.rdate', 'calendar.todo.rrule',
+                'calendar.todo.exdate', 'calendar.todo.exrule']:
+            child = pool.get(name).__table__()
+            recurrent |= Exists(child.select(Literal(1),
+                    where=child.todo == table.id))
+
+        for sub_ids in grouped_slice([t.id for t in todos]):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.id, list(sub_ids))
+                    & (table.parent != Null) & recurrent,
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
+                todo_id, = row
+                cls.raise_user_error('invalid_recurrence',
+                    (cls(todo_id).rec_name,))
 
     @classmethod
     def view_attributes(cls):
@@ -195,11 +425,25 @@ class Todo(ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
-        pool = Pool()
-        Calendar = pool.get('calendar.calendar')
-        Collection = pool.get('webdav.collection')
+        Propagation = Pool().get('calendar.todo.propagation')
 
         todos = super(Todo, cls).create(vlist)
+        cls._reset_parent_hash([t.id for t in todos])
+        if Propagation.deferred():
+            Propagation.enqueue_update(todos)
+        else:
+            cls._propagate_create(todos)
+        cls._statistics_cache_clear(set(t.calendar.id for t in todos))
+        return todos
+
+    @classmethod
+    @measured('todo.create.fanout')
+    def _propagate_create(cls, todos):
+        '''
+        Copy the created todos into the calendars of the attendees
+        '''
+        Calendar = Pool().get('calendar.calendar')
+
         for todo in todos:
             if (todo.calendar.owner
                     and (todo.organizer == todo.calendar.owner.email
@@ -215,7 +459,8 @@ class Todo(ModelSQL, ModelView):
                             if x.status != 'declined'
                             and x.email != todo.parent.organizer]
                 if attendee_emails:
-                    with Transaction().set_user(0):
+                    with Transaction().set_user(0), \
+                            Transaction().set_context(active_test=False):
                         calendars = Calendar.search([
                             ('owner.email', 'in', attendee_emails),
                             ])
@@ -246,43 +491,36 @@ class Todo(ModelSQL, ModelView):
                                     'parent': parent.id,
                                     'uuid': todo.uuid,
                                     })
-        # Restart the cache for todo
-        Collection._todo_cache.clear()
-        return todos
 
-    def _todo2update(self):
+    def _todo2update(self, todo):
+        '''
+        Return the values to write on the copy todo to update it like self
+        '''
         res = {}
         res['summary'] = self.summary
         res['description'] = self.description
         res['dtstart'] = self.dtstart
         res['percent_complete'] = self.percent_complete
         res['completed'] = self.completed
-        res['location'] = self.location.id
+        res['location'] = self.location.id if self.location else None
         res['status'] = self.status
         res['organizer'] = self.organizer
-        res['rdates'] = [('delete', [r.id for r in self.rdates])]
-        to_create = [rdate._date2update() for rdate in self.rdates]
-        if to_create:
-            res['rdates'].append(('create', to_create))
-        res['exdates'] = [('delete', [r.id for r in self.exdates])]
-        to_create = [exdate._date2update() for exdate in self.exdates]
-        if to_create:
-            res['exdates'].append(('create', to_create))
-        res['rrules'] = [('delete', [r.id for r in self.rrules])]
-        to_create = [rrule._rule2update() for rrule in self.rrules]
-        if to_create:
-            res['rrules'].append(('create', to_create))
-        res['exrules'] = [('delete', [r.id for r in self.exrules])]
-        to_create = [exrule._rule2update() for exrule in self.exrules]
-        if to_create:
-            res['exrules'].append(('create', to_create))
+        # The recurrences of the copy are replaced by those of self
+        for name, method in (('rdates', '_date2update'),
+                ('exdates', '_date2update'),
+                ('rrules', '_rule2update'),
+                ('exrules', '_rule2update')):
+            res[name] = [('delete', [r.id for r in getattr(todo, name)])]
+            to_create = [getattr(r, method)() for r in getattr(self, name)]
+            if to_create:
+                res[name].append(('create', to_create))
         return res
 
     @classmethod
     def write(cls, *args):
         pool = Pool()
-        Calendar = pool.get('calendar.calendar')
         Collection = pool.get('webdav.collection')
+        Propagation = pool.get('calendar.todo.propagation')
         table = cls.__table__()
 
         transaction = Transaction()
@@ -290,97 +528,164 @@ class Todo(ModelSQL, ModelView):
 
         actions = iter(args)
         args = []
+        calendar_ids = []
+        statistics_ids = set()
+        reparented = []
         for todos, values in zip(actions, actions):
             values = values.copy()
             if 'sequence' in values:
                 del values['sequence']
             args.extend((todos, values))
+            # The lookup of todo by uuid of the calendars changes
+            if set(values) & {'uuid', 'calendar', 'parent'}:
+                calendar_ids.extend(t.calendar.id for t in todos)
+                if values.get('calendar'):
+                    calendar_ids.append(values['calendar'])
+            if 'parent' in values:
+                reparented.extend(t.id for t in todos)
+            if set(values) & cls._statistics_fields():
+                statistics_ids.update(t.calendar.id for t in todos)
+                if values.get('calendar'):
+                    statistics_ids.add(values['calendar'])
+        # The previous parents lose the occurences
+        cls._reset_parent_hash(reparented)
 
         super(Todo, cls).write(*args)
 
-        ids = [t.id for t in todos]
+        ids = [t.id for todos in args[::2] for t in todos]
         for i in range(0, len(ids), transaction.database.IN_MAX):
             sub_ids = ids[i:i + transaction.database.IN_MAX]
             red_sql = reduce_ids(table.id, sub_ids)
             cursor.execute(*table.update(
-                    columns=[table.sequence],
-                    values=[table.sequence + 1],
+                    columns=[table.sequence, table.ical_hash],
+                    values=[table.sequence + 1, Null],
                     where=red_sql))
+        cls._reset_parent_hash(ids)
 
+        if Propagation.deferred():
+            actions = iter(args)
+            Propagation.enqueue_update(sum((list(todos)
+                        for todos, values in zip(actions, actions)
+                        if values), []))
+        else:
+            cls._propagate_write(args)
+        if calendar_ids:
+            Collection._todo_cache_clear(calendar_ids)
+        cls._statistics_cache_clear(statistics_ids)
+
+    @classmethod
+    @measured('todo.write.fanout')
+    def _propagate_write(cls, args):
+        '''
+        Update the copies of the written todos in the calendars of the
+        attendees
+        '''
         actions = iter(args)
         for todos, values in zip(actions, actions):
-            if not values:
-                continue
-            for todo in todos:
-                if (todo.calendar.owner
-                        and (todo.organizer == todo.calendar.owner.email
-                            or (todo.parent
-                                and todo.parent.organizer
-                                == todo.calendar.owner.email))):
-                    if todo.organizer == todo.calendar.owner.email:
-                        attendee_emails = [x.email for x in todo.attendees
-                                if x.status != 'declined'
-                                and x.email != todo.organizer]
-                    else:
-                        attendee_emails = [
-                            x.email for x in todo.parent.attendees
+            if values:
+                cls._propagate_update(todos)
+
+    @classmethod
+    def _propagate_update(cls, todos):
+        '''
+        Update the copies of the todos in the calendars of the attendees and
+        create the missing ones
+        '''
+        Calendar = Pool().get('calendar.calendar')
+
+        for todo in todos:
+            if (todo.calendar.owner
+                    and (todo.organizer == todo.calendar.owner.email
+                        or (todo.parent
+                            and todo.parent.organizer
+                            == todo.calendar.owner.email))):
+                if todo.organizer == todo.calendar.owner.email:
+                    attendee_emails = [x.email for x in todo.attendees
                             if x.status != 'declined'
-                            and x.email != todo.parent.organizer]
-                    if attendee_emails:
+                            and x.email != todo.organizer]
+                else:
+                    attendee_emails = [
+                        x.email for x in todo.parent.attendees
+                        if x.status != 'declined'
+                        and x.email != todo.parent.organizer]
+                if attendee_emails:
+                    with Transaction().set_user(0), \
+                            Transaction().set_context(active_test=False):
+                        todo2s = cls.search([
+                                ('uuid', '=', todo.uuid),
+                                ('calendar.owner.email', 'in',
+                                    attendee_emails),
+                                ('id', '!=', todo.id),
+                                ('recurrence', '=', todo.recurrence),
+                                ])
+                    for todo2 in todo2s:
+                        if todo2.calendar.owner.email in attendee_emails:
+                            attendee_emails.remove(
+                                todo2.calendar.owner.email)
+                    if todo2s:
                         with Transaction().set_user(0):
-                            todo2s = cls.search([
+                            cls.write(*chain(*(([t], todo._todo2update(t))
+                                        for t in todo2s)))
+                if attendee_emails:
+                    with Transaction().set_user(0), \
+                            Transaction().set_context(active_test=False):
+                        calendars = Calendar.search([
+                            ('owner.email', 'in', attendee_emails),
+                            ])
+                        if not todo.recurrence:
+                            for calendar in calendars:
+                                new_todo, = cls.copy([todo], default={
+                                    'calendar': calendar.id,
+                                    'occurences': None,
+                                    'uuid': todo.uuid,
+                                    })
+                                for occurence in todo.occurences:
+                                    cls.copy([occurence], default={
+                                        'calendar': calendar.id,
+                                        'parent': new_todo.id,
+                                        'uuid': occurence.uuid,
+                                        })
+                        else:
+                            parents = cls.search([
                                     ('uuid', '=', todo.uuid),
                                     ('calendar.owner.email', 'in',
                                         attendee_emails),
                                     ('id', '!=', todo.id),
-                                    ('recurrence', '=', todo.recurrence),
+                                    ('recurrence', '=', None),
                                     ])
-                        for todo2 in todo2s:
-                            if todo2.calendar.owner.email in attendee_emails:
-                                attendee_emails.remove(
-                                    todo2.calendar.owner.email)
-                        with Transaction().set_user(0):
-                            cls.write(todos, todo._todo2update())
-                    if attendee_emails:
-                        with Transaction().set_user(0):
-                            calendars = Calendar.search([
-                                ('owner.email', 'in', attendee_emails),
-                                ])
-                            if not todo.recurrence:
-                                for calendar in calendars:
-                                    new_todo, = cls.copy([todo], default={
-                                        'calendar': calendar.id,
-                                        'occurences': None,
-                                        'uuid': todo.uuid,
-                                        })
-                                    for occurence in todo.occurences:
-                                        cls.copy([occurence], default={
-                                            'calendar': calendar.id,
-                                            'parent': new_todo.id,
-                                            'uuid': occurence.uuid,
-                                            })
-                            else:
-                                parents = cls.search([
-                                        ('uuid', '=', todo.uuid),
-                                        ('calendar.owner.email', 'in',
-                                            attendee_emails),
-                                        ('id', '!=', todo.id),
-                                        ('recurrence', '=', None),
-                                        ])
-                                for parent in parents:
-                                    cls.copy([todo], default={
-                                        'calendar': parent.calendar.id,
-                                        'parent': parent.id,
-                                        'uuid': todo.uuid,
-                                        })
-        # Restart the cache for todo
-        Collection._todo_cache.clear()
+                            for parent in parents:
+                                cls.copy([todo], default={
+                                    'calendar': parent.calendar.id,
+                                    'parent': parent.id,
+                                    'uuid': todo.uuid,
+                                    })
 
     @classmethod
     def delete(cls, todos):
         pool = Pool()
-        Attendee = pool.get('calendar.todo.attendee')
         Collection = pool.get('webdav.collection')
+        Tombstone = pool.get('calendar.todo.tombstone')
+        Propagation = pool.get('calendar.todo.propagation')
+
+        calendar_ids = [t.calendar.id for t in todos]
+        if Propagation.deferred():
+            Propagation.enqueue_delete(todos)
+        else:
+            cls._propagate_delete(todos)
+        Tombstone.add([t.id for t in todos])
+        cls._reset_parent_hash([t.id for t in todos])
+        super(Todo, cls).delete(todos)
+        Collection._todo_cache_clear(calendar_ids)
+        cls._statistics_cache_clear(calendar_ids)
+
+    @classmethod
+    @measured('todo.delete.fanout')
+    def _propagate_delete(cls, todos):
+        '''
+        Delete the copies of the deleted todos from the calendars of the
+        attendees or decline the invitation of the organizer
+        '''
+        Attendee = Pool().get('calendar.todo.attendee')
 
         for todo in todos:
             if (todo.calendar.owner
@@ -395,7 +700,8 @@ class Todo(ModelSQL, ModelView):
                     attendee_emails = [x.email for x in todo.parent.attendees
                             if x.email != todo.parent.organizer]
                 if attendee_emails:
-                    with Transaction().set_user(0):
+                    with Transaction().set_user(0), \
+                            Transaction().set_context(active_test=False):
                         todos_delete = cls.search([
                             ('uuid', '=', todo.uuid),
                             ('calendar.owner.email', 'in', attendee_emails),
@@ -409,7 +715,8 @@ class Todo(ModelSQL, ModelView):
                     organizer = todo.organizer
                 else:
                     organizer = todo.parent.organizer
-                with Transaction().set_user(0):
+                with Transaction().set_user(0), \
+                        Transaction().set_context(active_test=False):
                     todo2s = cls.search([
                         ('uuid', '=', todo.uuid),
                         ('calendar.owner.email', '=', organizer),
@@ -423,9 +730,162 @@ class Todo(ModelSQL, ModelView):
                                 Attendee.write([attendee], {
                                     'status': 'declined',
                                     })
-        super(Todo, cls).delete(todos)
-        # Restart the cache for todo
-        Collection._todo_cache.clear()
+
+    @classmethod
+    def _check_write(cls, ids):
+        '''
+        Check the access and the record rules allow to write the todos like
+        write does
+        '''
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        Rule = pool.get('ir.rule')
+
+        ModelAccess.check(cls.__name__, 'write')
+        domain = Rule.domain_get(cls.__name__, mode='write')
+        if domain:
+            with Transaction().set_context(active_test=False):
+                if cls.search_count([
+                            ('id', 'in', ids),
+                            domain,
+                            ]) != len(ids):
+                    cls.raise_user_error('access_error', cls.__doc__)
+
+    @classmethod
+    def set_status(cls, todos, status):
+        '''
+        Set the status of the todos and of their copies in the calendars of
+        the attendees with a few queries. Completing a todo sets its percent
+        complete to 100 and its completed date if empty.
+        '''
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if status not in dict(cls.status.selection):
+            cls.raise_user_error('invalid_status', (status,))
+        if not todos:
+            return
+        ids = list(set(t.id for t in todos))
+        cls._check_write(ids)
+
+        keys = {}
+        for todo in todos:
+            attendee_emails = cls._attendee_emails(todo)
+            if attendee_emails:
+                keys[todo.id] = (
+                    todo.uuid, todo.recurrence, tuple(attendee_emails))
+        if keys:
+            with transaction.set_user(0):
+                copies = cls._copies(keys.values())
+            for key in keys.itervalues():
+                ids.extend(copies[key])
+            ids = list(set(ids))
+
+        columns = [table.status, table.sequence, table.ical_hash,
+            table.write_uid, table.write_date]
+        values = [status, table.sequence + 1, Null, transaction.user,
+            CurrentTimestamp()]
+        if status == 'completed':
+            columns += [table.percent_complete, table.completed]
+            values += [100, Coalesce(table.completed,
+                    datetime.datetime.now().replace(microsecond=0))]
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(columns=columns, values=values,
+                    where=reduce_ids(table.id, list(sub_ids))))
+        cls._clear_transaction_cache(ids)
+        cls._reset_parent_hash(ids)
+
+        cls._statistics_cache_clear(cls._calendar_ids(ids))
+
+    @classmethod
+    def archive(cls, age=None):
+        '''
+        Archive the todos completed or cancelled for more than age days with
+        their occurences. The default age is the archive_age of the
+        calendar_todo configuration section.
+        The archived todos are no more listed but can still be read, they are
+        recorded as deleted for changed_since.
+        Return the number of archived todos.
+        '''
+        pool = Pool()
+        Tombstone = pool.get('calendar.todo.tombstone')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if age is None:
+            age = config.getint('calendar_todo', 'archive_age', default=365)
+        limit = datetime.datetime.now() - datetime.timedelta(days=age)
+        cursor.execute(*table.select(table.id,
+                where=(table.parent == Null)
+                & (table.active == True)
+                & table.status.in_(['completed', 'cancelled'])
+                & (Coalesce(table.completed, table.write_date,
+                        table.create_date) < limit)))
+        ids = [i for i, in cursor.fetchall()]
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            where = ((reduce_ids(table.id, sub_ids)
+                    | reduce_ids(table.parent, sub_ids))
+                & (table.active == True))
+            cursor.execute(*table.select(table.id, where=where))
+            Tombstone.add([i for i, in cursor.fetchall()])
+            cursor.execute(*table.update(
+                    columns=[table.active],
+                    values=[False],
+                    where=where))
+        cls._statistics_cache_clear(cls._calendar_ids(ids))
+        logger.info('%s todos archived', len(ids))
+        return len(ids)
+
+    @staticmethod
+    def _attendee_emails(todo):
+        """
+        Return the emails of the attendees of the todo other than the
+        organizer or None if the owner of the calendar is not the organizer
+        """
+        owner = todo.calendar.owner
+        if not owner:
+            return None
+        if todo.organizer == owner.email:
+            return [x.email for x in todo.attendees
+                if x.email != todo.organizer]
+        elif todo.parent and todo.parent.organizer == owner.email:
+            return [x.email for x in todo.parent.attendees
+                if x.email != todo.parent.organizer]
+
+    @classmethod
+    def _copies(cls, keys):
+        """
+        Return for each key of (uuid, recurrence, owner emails) the ids of the
+        todos with the same uuid and recurrence in the calendars owned by the
+        emails
+        """
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        User = pool.get('res.user')
+        table = cls.__table__()
+        calendar = Calendar.__table__()
+        user = User.__table__()
+        cursor = Transaction().connection.cursor()
+
+        copies = dict((k, []) for k in keys)
+        todos = {}
+        query_table = table.join(calendar,
+            condition=table.calendar == calendar.id
+            ).join(user, condition=calendar.owner == user.id)
+        for sub_uuids in grouped_slice(set(k[0] for k in keys)):
+            cursor.execute(*query_table.select(
+                    table.id, table.uuid, table.recurrence, user.email,
+                    where=table.uuid.in_(list(sub_uuids))))
+            for todo_id, uuid_, recurrence, email in cursor.fetchall():
+                todos.setdefault((uuid_, recurrence), []).append(
+                    (todo_id, email))
+        for key in keys:
+            uuid_, recurrence, emails = key
+            copies[key] = [i for i, e in todos.get((uuid_, recurrence), [])
+                if e in emails]
+        return copies
 
     @classmethod
     def copy(cls, todos, default=None):
@@ -436,11 +896,259 @@ class Todo(ModelSQL, ModelView):
         for todo in todos:
             current_default = default.copy()
             current_default.setdefault('uuid', cls.default_uuid())
+            current_default.setdefault('ical_hash', None)
             new_todo, = super(Todo, cls).copy([todo], default=current_default)
             new_todos.append(new_todo)
         return new_todos
 
+    @staticmethod
+    def _statistics_fields():
+        'Return the fields used to compute the statistics'
+        return {'calendar', 'parent', 'status', 'percent_complete', 'due',
+            'active'}
+
+    @classmethod
+    def _statistics_cache(cls, calendar_id):
+        'Return the cache of the statistics of the calendar'
+        return cls._statistics_caches[
+            calendar_id % len(cls._statistics_caches)]
+
+    @classmethod
+    def _statistics_cache_clear(cls, calendar_ids=None):
+        '''
+        Clear the cache of the statistics of the calendars or of all
+        '''
+        if calendar_ids is None:
+            caches = cls._statistics_caches
+        else:
+            caches = set(cls._statistics_cache(c) for c in calendar_ids)
+        for cache in caches:
+            cache.clear()
+
+    @classmethod
+    def _calendar_ids(cls, ids):
+        'Return the ids of the calendars of the todo ids'
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        calendar_ids = set()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(table.calendar,
+                    where=reduce_ids(table.id, list(sub_ids)),
+                    group_by=[table.calendar]))
+            calendar_ids.update(c for c, in cursor.fetchall())
+        return calendar_ids
+
+    @classmethod
+    def get_statistics(cls, calendar_ids):
+        """
+        Return for each readable calendar a dictionary with:
+        id: the calendar id
+        count: the number of active todos
+        status: the number of todos per status
+        percent_complete: the average percent complete
+        overdue: the number of todos due in the past and not completed or
+            cancelled
+        """
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        calendar_ids = [c.id for c in Calendar.search([
+                    ('id', 'in', list(calendar_ids)),
+                    ], order=[])]
+        now = datetime.datetime.now()
+        statistics, to_compute = {}, []
+        for calendar_id in calendar_ids:
+            value = cls._statistics_cache(calendar_id).get(calendar_id)
+            if (value is None
+                    or (value['valid_until']
+                        and value['valid_until'] <= now)):
+                to_compute.append(calendar_id)
+            else:
+                statistics[calendar_id] = value
+
+        pending = ~Coalesce(table.status, '').in_(['completed', 'cancelled'])
+        overdue = Case((pending & (table.due < now), 1), else_=0)
+        next_due = Case((pending & (table.due >= now), table.due),
+            else_=Null)
+        for sub_ids in grouped_slice(to_compute):
+            sub_ids = list(sub_ids)
+            values = dict((i, {
+                        'count': 0,
+                        'status': {},
+                        'percent_complete': 0,
+                        'overdue': 0,
+                        'valid_until': None,
+                        }) for i in sub_ids)
+            cursor.execute(*table.select(table.calendar, table.status,
+                    Count(Literal('*')), Sum(table.percent_complete),
+                    Sum(overdue), Min(next_due),
+                    where=reduce_ids(table.calendar, sub_ids)
+                    & (table.parent == Null)
+                    & (table.active == True),
+                    group_by=[table.calendar, table.status]))
+            for (calendar_id, status, count, percent, overdue_count,
+                    valid_until) in cursor.fetchall():
+                value = values[calendar_id]
+                value['count'] += count
+                value['status'][status or ''] = count
+                value['percent_complete'] += percent or 0
+                value['overdue'] += overdue_count or 0
+                if isinstance(valid_until, basestring):
+                    valid_until = datetime.datetime.strptime(
+                        valid_until[:19], '%Y-%m-%d %H:%M:%S')
+                if valid_until and (not value['valid_until']
+                        or valid_until < value['valid_until']):
+                    value['valid_until'] = valid_until
+            for calendar_id, value in values.iteritems():
+                if value['count']:
+                    value['percent_complete'] = (
+                        float(value['percent_complete']) / value['count'])
+                cls._statistics_cache(calendar_id).set(calendar_id, value)
+                statistics[calendar_id] = value
+
+        result = []
+        for calendar_id in calendar_ids:
+            value = statistics[calendar_id].copy()
+            value['status'] = value['status'].copy()
+            del value['valid_until']
+            value['id'] = calendar_id
+            result.append(value)
+        return result
+
+    @staticmethod
+    def _sql_datetime(value):
+        'Return the datetime of the value read by SQL'
+        if isinstance(value, basestring):
+            if '.' in value:
+                value = datetime.datetime.strptime(value,
+                    '%Y-%m-%d %H:%M:%S.%f')
+            else:
+                value = datetime.datetime.strptime(value,
+                    '%Y-%m-%d %H:%M:%S')
+        return value
+
+    @classmethod
+    def changed_since(cls, cursor=None, domain=None):
+        '''
+        Return the todos of the domain created, modified or deleted since
+        the cursor as a dictionary with:
+        cursor: the cursor to use for the next call
+        changed: the list of id and date of the created or modified todos
+        deleted: the ids of the deleted or archived todos
+        Without cursor, all the todos are returned as changed.
+        The deletions are filtered by the clauses of the domain on the fields
+        recorded by the tombstones, so they may contain todos of the domain
+        already unknown to the client.
+        The changes of the margin before the cursor are returned again to
+        not miss those of transactions committed late.
+        '''
+        pool = Pool()
+        Tombstone = pool.get('calendar.todo.tombstone')
+        table = cls.__table__()
+        tombstone = Tombstone.__table__()
+        sql_cursor = Transaction().connection.cursor()
+
+        last = since = None
+        if cursor:
+            last = datetime.datetime.strptime(cursor, CURSOR_FORMAT)
+            since = last - datetime.timedelta(seconds=config.getint(
+                    'calendar_todo', 'changes_margin', default=60))
+
+        timestamp = Coalesce(table.write_date, table.create_date)
+        where = table.id.in_(cls.search(domain or [], order=[], query=True))
+        if since:
+            where &= timestamp >= since
+        sql_cursor.execute(*table.select(table.id, timestamp,
+                where=where,
+                order_by=[timestamp, table.id]))
+        changed = []
+        for todo_id, date in sql_cursor.fetchall():
+            date = cls._sql_datetime(date)
+            changed.append((todo_id, date))
+            if last is None or date > last:
+                last = date
+
+        deleted = []
+        if since:
+            changed_ids = set(i for i, _ in changed)
+            query = Tombstone.search([
+                    ('create_date', '>=', since),
+                    Tombstone.convert_domain(domain or []),
+                    ], order=[], query=True)
+            sql_cursor.execute(*tombstone.select(
+                    tombstone.todo, tombstone.create_date,
+                    where=tombstone.id.in_(query),
+                    order_by=[tombstone.create_date, tombstone.id]))
+            for todo_id, date in sql_cursor.fetchall():
+                # The todo has been restored since
+                if todo_id not in changed_ids:
+                    deleted.append(todo_id)
+                date = cls._sql_datetime(date)
+                if date > last:
+                    last = date
+
+        return {
+            'cursor': last.strftime(CURSOR_FORMAT) if last else None,
+            'changed': changed,
+            'deleted': deleted,
+            }
+
+    @staticmethod
+    def _plain_hash(plain):
+        'Return the hash of the plain values from ical2plain'
+        def default(value):
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                return value.isoformat()
+            raise TypeError(repr(value))
+        return hashlib.sha1(json.dumps(plain, sort_keys=True,
+                default=default)).hexdigest()
+
     @classmethod
+    def _reset_parent_hash(cls, ids):
+        '''
+        Reset the hash of the parents of the todos as their iCalendar
+        contains the occurences
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        parent_ids = set()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(table.parent,
+                    where=reduce_ids(table.id, list(sub_ids))
+                    & (table.parent != Null)))
+            parent_ids.update(p for p, in cursor.fetchall())
+        for sub_ids in grouped_slice(parent_ids):
+            cursor.execute(*table.update(
+                    columns=[table.ical_hash],
+                    values=[Null],
+                    where=reduce_ids(table.id, list(sub_ids))))
+        cls._clear_transaction_cache(parent_ids)
+
+    @classmethod
+    def _clear_transaction_cache(cls, ids):
+        'Remove the todos updated by SQL from the cache of the transaction'
+        for cache in Transaction().cache.itervalues():
+            if cls.__name__ in cache:
+                for id_ in ids:
+                    cache[cls.__name__].pop(id_, None)
+
+    @classmethod
+    def set_ical_hash(cls, todo_id, ical_hash):
+        'Store the hash of the iCalendar put for the todo without writing it'
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.update(
+                columns=[table.ical_hash],
+                values=[ical_hash],
+                where=table.id == todo_id))
+        cls._clear_transaction_cache([todo_id])
+
+    @classmethod
+    @measured('todo.ical2values')
     def ical2values(cls, todo_id, ical, calendar_id, vtodo=None):
         '''
         Convert iCalendar to values for create or write with:
@@ -449,9 +1157,30 @@ class Todo(ModelSQL, ModelView):
         calendar_id: the calendar id of the todo
         vtodo: the vtodo of the ical to use if None use the first one
         '''
+        return cls.plain2values(todo_id, cls.ical2plain(ical, vtodo=vtodo),
+            calendar_id)
+
+    @staticmethod
+    def _ical_datetime(value):
+        if not isinstance(value, datetime.datetime):
+            return datetime.datetime.combine(value, datetime.time())
+        elif value.tzinfo:
+            return value.astimezone(tzlocal)
+        return value
+
+    @classmethod
+    @measured('todo.ical2plain')
+    def ical2plain(cls, ical, vtodo=None):
+        '''
+        Convert iCalendar to plain values without database access with:
+        ical: a ical instance of vobject
+        vtodo: the vtodo of the ical to use if None use the first one and
+            convert the others as occurences
+
+        The categories and the location are stored by name and the
+        relations as lists of values to create. The result can be pickled.
+        '''
         pool = Pool()
-        Category = pool.get('calendar.category')
-        Location = pool.get('calendar.location')
         Alarm = pool.get('calendar.todo.alarm')
         Attendee = pool.get('calendar.todo.attendee')
         Rdate = pool.get('calendar.todo.rdate')
@@ -468,15 +1197,11 @@ class Todo(ModelSQL, ModelView):
                         and i != vtodo:
                     vtodos.append(i)
 
-        todo = None
-        if todo_id:
-            todo = cls(todo_id)
         res = {}
-        if not todo:
-            if hasattr(vtodo, 'uid'):
-                res['uuid'] = vtodo.uid.value
-            else:
-                res['uuid'] = str(uuid.uuid4())
+        if hasattr(vtodo, 'uid'):
+            res['uuid'] = vtodo.uid.value
+        else:
+            res['uuid'] = str(uuid.uuid4())
         if hasattr(vtodo, 'summary'):
             res['summary'] = vtodo.summary.value
         else:
@@ -491,46 +1216,15 @@ class Todo(ModelSQL, ModelView):
             res['percent_complete'] = 0
 
         if hasattr(vtodo, 'completed'):
-            if not isinstance(vtodo.completed.value, datetime.datetime):
-                res['completed'] = datetime.datetime.combine(
-                    vtodo.completed.value, datetime.time())
-            else:
-                if vtodo.completed.value.tzinfo:
-                    res['completed'] = vtodo.completed.value.astimezone(
-                        tzlocal)
-                else:
-                    res['completed'] = vtodo.completed.value
-
+            res['completed'] = cls._ical_datetime(vtodo.completed.value)
         if hasattr(vtodo, 'dtstart'):
-            if not isinstance(vtodo.dtstart.value, datetime.datetime):
-                res['dtstart'] = datetime.datetime.combine(vtodo.dtstart.value,
-                        datetime.time())
-            else:
-                if vtodo.dtstart.value.tzinfo:
-                    res['dtstart'] = vtodo.dtstart.value.astimezone(tzlocal)
-                else:
-                    res['dtstart'] = vtodo.dtstart.value
-
+            res['dtstart'] = cls._ical_datetime(vtodo.dtstart.value)
         if hasattr(vtodo, 'due'):
-            if not isinstance(vtodo.due.value, datetime.datetime):
-                res['due'] = datetime.datetime.combine(vtodo.due.value,
-                        datetime.time())
-            else:
-                if vtodo.due.value.tzinfo:
-                    res['due'] = vtodo.due.value.astimezone(tzlocal)
-                else:
-                    res['due'] = vtodo.due.value
+            res['due'] = cls._ical_datetime(vtodo.due.value)
 
         if hasattr(vtodo, 'recurrence-id'):
-            if not isinstance(vtodo.recurrence_id.value, datetime.datetime):
-                res['recurrence'] = datetime.datetime.combine(
-                        vtodo.recurrence_id.value, datetime.time())
-            else:
-                if vtodo.recurrence_id.value.tzinfo:
-                    res['recurrence'] = \
-                        vtodo.recurrence_id.value.astimezone(tzlocal)
-                else:
-                    res['recurrence'] = vtodo.recurrence_id.value
+            res['recurrence'] = cls._ical_datetime(
+                vtodo.recurrence_id.value)
         else:
             res['recurrence'] = None
         if hasattr(vtodo, 'status'):
@@ -538,25 +1232,10 @@ class Todo(ModelSQL, ModelView):
         else:
             res['status'] = ''
 
-        res['categories'] = []
-        if todo:
-            res['categories'] += [('remove', [c.id for c in todo.categories])]
         if hasattr(vtodo, 'categories'):
-            categories = Category.search([
-                ('name', 'in', [x for x in vtodo.categories.value]),
-                ])
-            category_names2ids = {}
-            for category in categories:
-                category_names2ids[category.name] = category.id
-            to_create = []
-            for category in vtodo.categories.value:
-                if category not in category_names2ids:
-                    to_create.append({
-                            'name': category,
-                            })
-            if to_create:
-                categories += Category.create(to_create)
-            res['categories'] += [('add', [c.id for c in categories])]
+            res['categories'] = list(vtodo.categories.value)
+        else:
+            res['categories'] = []
         if hasattr(vtodo, 'class'):
             if getattr(vtodo, 'class').value.lower() in \
                     dict(cls.classification.selection):
@@ -566,21 +1245,10 @@ class Todo(ModelSQL, ModelView):
         else:
             res['classification'] = 'public'
         if hasattr(vtodo, 'location'):
-            locations = Location.search([
-                ('name', '=', vtodo.location.value),
-                ], limit=1)
-            if not locations:
-                location, = Location.create([{
-                            'name': vtodo.location.value,
-                            }])
-            else:
-                location, = locations
-            res['location'] = location.id
+            res['location'] = vtodo.location.value
         else:
             res['location'] = None
 
-        res['calendar'] = calendar_id
-
         if hasattr(vtodo, 'organizer'):
             if vtodo.organizer.value.lower().startswith('mailto:'):
                 res['organizer'] = vtodo.organizer.value[7:]
@@ -589,82 +1257,43 @@ class Todo(ModelSQL, ModelView):
         else:
             res['organizer'] = None
 
-        attendees_todel = {}
-        if todo:
-            for attendee in todo.attendees:
-                attendees_todel[attendee.email] = attendee.id
         res['attendees'] = []
         if hasattr(vtodo, 'attendee'):
-            to_create = []
             while vtodo.attendee_list:
                 attendee = vtodo.attendee_list.pop()
-                vals = Attendee.attendee2values(attendee)
-                if vals['email'] in attendees_todel:
-                    res['attendees'].append(('write',
-                        attendees_todel[vals['email']], vals))
-                    del attendees_todel[vals['email']]
-                else:
-                    to_create.append(vals)
-            if to_create:
-                res['attendees'].append(('create', to_create))
-        res['attendees'].append(('delete', attendees_todel.values()))
+                res['attendees'].append(Attendee.attendee2values(attendee))
 
         res['rdates'] = []
-        if todo:
-            res['rdates'].append(('delete', [x.id for x in todo.rdates]))
         if hasattr(vtodo, 'rdate'):
-            to_create = []
             while vtodo.rdate_list:
                 rdate = vtodo.rdate_list.pop()
-                to_create += [Rdate.date2values(date) for date in rdate.value]
-            if to_create:
-                res['rdates'].append(('create', to_create))
+                res['rdates'] += [Rdate.date2values(date)
+                    for date in rdate.value]
 
         res['exdates'] = []
-        if todo:
-            res['exdates'].append(('delete', [x.id for x in todo.exdates]))
         if hasattr(vtodo, 'exdate'):
-            to_create = []
             while vtodo.exdate_list:
                 exdate = vtodo.exdate_list.pop()
-                to_create += [Exdate.date2values(date)
+                res['exdates'] += [Exdate.date2values(date)
                     for date in exdate.value]
-            if to_create:
-                res['exdates'].append(('create', to_create))
 
         res['rrules'] = []
-        if todo:
-            res['rrules'].append(('delete', [x.id for x in todo.rrules]))
         if hasattr(vtodo, 'rrule'):
-            to_create = []
             while vtodo.rrule_list:
                 rrule = vtodo.rrule_list.pop()
-                to_create.append(Rrule.rule2values(rrule))
-            if to_create:
-                res['rrules'].append(('create', to_create))
+                res['rrules'].append(Rrule.rule2values(rrule))
 
         res['exrules'] = []
-        if todo:
-            res['exrules'].append(('delete', [x.id for x in todo.exrules]))
         if hasattr(vtodo, 'exrule'):
-            to_create = []
             while vtodo.exrule_list:
                 exrule = vtodo.exrule_list.pop()
-                to_create.append(Exrule.rule2values(exrule))
-            if to_create:
-                res['exrules'].append(('create', to_create))
+                res['exrules'].append(Exrule.rule2values(exrule))
 
-        if todo:
-            res.setdefault('alarms', [])
-            res['alarms'].append(('delete', [x.id for x in todo.alarms]))
+        res['alarms'] = []
         if hasattr(vtodo, 'valarm'):
-            res.setdefault('alarms', [])
-            to_create = []
             while vtodo.valarm_list:
                 valarm = vtodo.valarm_list.pop()
-                to_create.append(Alarm.valarm2values(valarm))
-            if to_create:
-                res['alarms'].append(('create', to_create))
+                res['alarms'].append(Alarm.valarm2values(valarm))
 
         if hasattr(ical, 'vtimezone'):
             if ical.vtimezone.tzid.value in pytz.common_timezones:
@@ -676,35 +1305,206 @@ class Todo(ModelSQL, ModelView):
 
         res['vtodo'] = vtodo.serialize()
 
+        res['occurences'] = [cls.ical2plain(ical, vtodo=vtodo)
+            for vtodo in vtodos]
+        return res
+
+    @staticmethod
+    def _normalize_value(value):
+        'Return the value as it is read from the database'
+        if isinstance(value, datetime.datetime) and value.tzinfo:
+            value = value.astimezone(tzlocal).replace(tzinfo=None)
+        elif isinstance(value, Model):
+            value = value.id
+        elif isinstance(value, (bytearray, buffer)):
+            value = bytes(value)
+        return value
+
+    @classmethod
+    def _changed_values(cls, record, values):
+        'Return the values which differ from the stored record'
+        normalize = cls._normalize_value
+        return dict((n, v) for n, v in values.iteritems()
+            if normalize(getattr(record, n)) != normalize(v))
+
+    @classmethod
+    def _children_actions(cls, records, vlist):
+        """
+        Return the actions to replace the records by the values of vlist
+        keeping the records having already the same values
+        """
+        normalize = cls._normalize_value
+        names = set()
+        for values in vlist:
+            names.update(values)
+        names = sorted(names)
+
+        existing = {}
+        for record in records:
+            key = tuple(normalize(getattr(record, n)) for n in names)
+            existing.setdefault(key, []).append(record.id)
+        to_create = []
+        for values in vlist:
+            key = tuple(normalize(values.get(n)) for n in names)
+            if existing.get(key):
+                existing[key].pop()
+            else:
+                to_create.append(values)
+        to_delete = [i for ids in existing.itervalues() for i in ids]
+
+        actions = []
+        if to_delete:
+            actions.append(('delete', to_delete))
+        if to_create:
+            actions.append(('create', to_create))
+        return actions
+
+    @classmethod
+    def plain2values(cls, todo_id, plain, calendar_id, categories=None,
+            locations=None):
+        '''
+        Convert plain values from ical2plain to values for create or write
+        with:
+        todo_id: the todo id for write or None for create
+        plain: the plain values
+        calendar_id: the calendar id of the todo
+        categories: a dictionary of category name to id already known
+        locations: a dictionary of location name to id already known
+
+        For write, only the values and the relations which differ from the
+        stored todo are returned.
+        '''
+        pool = Pool()
+        Category = pool.get('calendar.category')
+        Location = pool.get('calendar.location')
+
+        todo = None
+        if todo_id:
+            todo = cls(todo_id)
+        res = plain.copy()
+        for field in ('categories', 'location', 'attendees', 'rdates',
+                'exdates', 'rrules', 'exrules', 'alarms', 'occurences'):
+            del res[field]
+        if todo:
+            del res['uuid']
+
+        category_ids = set()
+        if plain['categories']:
+            if categories is None:
+                categories = {}
+            names = [n for n in plain['categories'] if n not in categories]
+            if names:
+                for category in Category.search([
+                            ('name', 'in', names),
+                            ]):
+                    categories[category.name] = category.id
+            to_create = [{
+                    'name': n,
+                    } for n in set(plain['categories']) if n not in categories]
+            if to_create:
+                for category in Category.create(to_create):
+                    categories[category.name] = category.id
+            category_ids = set(categories[n] for n in plain['categories'])
+        res['categories'] = []
+        if todo:
+            current_ids = set(c.id for c in todo.categories)
+            to_remove = current_ids - category_ids
+            if to_remove:
+                res['categories'].append(('remove', list(to_remove)))
+            category_ids -= current_ids
+        if category_ids:
+            res['categories'].append(('add', list(category_ids)))
+        if not res['categories']:
+            del res['categories']
+        if plain['location']:
+            if locations is None:
+                locations = {}
+            if plain['location'] not in locations:
+                location_records = Location.search([
+                        ('name', '=', plain['location']),
+                        ], limit=1)
+                if not location_records:
+                    location, = Location.create([{
+                                'name': plain['location'],
+                                }])
+                else:
+                    location, = location_records
+                locations[plain['location']] = location.id
+            res['location'] = locations[plain['location']]
+        else:
+            res['location'] = None
+
+        res['calendar'] = calendar_id
+
+        if todo:
+            scalars = dict((n, v) for n, v in res.iteritems()
+                if n != 'categories')
+            for name in scalars:
+                del res[name]
+            res.update(cls._changed_values(todo, scalars))
+
+        attendees_todel = {}
+        if todo:
+            for attendee in todo.attendees:
+                attendees_todel[attendee.email] = attendee
+        res['attendees'] = []
+        to_create = []
+        for vals in plain['attendees']:
+            if vals['email'] in attendees_todel:
+                attendee = attendees_todel.pop(vals['email'])
+                vals = cls._changed_values(attendee, vals)
+                if vals:
+                    res['attendees'].append(('write', [attendee.id], vals))
+            else:
+                to_create.append(vals)
+        if to_create:
+            res['attendees'].append(('create', to_create))
+        if attendees_todel:
+            res['attendees'].append(('delete',
+                    [a.id for a in attendees_todel.itervalues()]))
+        if not res['attendees']:
+            del res['attendees']
+
+        for field in ('rdates', 'exdates', 'rrules', 'exrules', 'alarms'):
+            actions = cls._children_actions(
+                getattr(todo, field) if todo else [], plain[field])
+            if actions:
+                res[field] = actions
+
         occurences_todel = []
         if todo:
             occurences_todel = [x.id for x in todo.occurences]
         to_create = []
-        for vtodo in vtodos:
+        for occurence_plain in plain['occurences']:
             todo_id = None
             if todo:
+                recurrence = occurence_plain['recurrence']
+                if recurrence and not recurrence.tzinfo:
+                    recurrence = recurrence.replace(tzinfo=tzlocal)
                 for occurence in todo.occurences:
                     if occurence.recurrence.replace(tzinfo=tzlocal) \
-                            == vtodo.recurrence_id.value:
+                            == recurrence:
                         todo_id = occurence.id
                         occurences_todel.remove(occurence.id)
-            vals = cls.ical2values(todo_id, ical, calendar_id, vtodo=vtodo)
-            if todo:
-                vals['uuid'] = todo.uuid
-            else:
-                vals['uuid'] = res['uuid']
+            vals = cls.plain2values(todo_id, occurence_plain, calendar_id,
+                categories=categories, locations=locations)
             res.setdefault('occurences', [])
             if todo_id:
-                res['occurences'].append(('write', todo_id, vals))
+                if vals:
+                    res['occurences'].append(('write', [todo_id], vals))
             else:
+                vals['uuid'] = todo.uuid if todo else res['uuid']
                 to_create.append(vals)
         if to_create:
             res['occurences'].append(('create', to_create))
         if occurences_todel:
             res.setdefault('occurences', [])
             res['occurences'].append(('delete', occurences_todel))
+        if not res.get('occurences', True):
+            del res['occurences']
         return res
 
+    @measured('todo.todo2ical')
     def todo2ical(self):
         '''
         Return an iCalendar instance of vobject for todo
@@ -851,7 +1651,7 @@ class Todo(ModelSQL, ModelView):
                 vtodo.valarm_list.append(valarm)
 
         for occurence in self.occurences:
-            rical = self.todo2ical(occurence)
+            rical = occurence.todo2ical()
             ical.vtodo_list.append(rical.vtodo)
         return ical
 
@@ -1042,9 +1842,48 @@ class TodoAttendee(AttendeeMixin, ModelSQL, ModelView):
                                 attendee.id == sql_table.calendar_attendee))]))
             table.drop_column('calendar_attendee', True)
 
+    @classmethod
+    def _copies(cls, keys):
+        """
+        Return for each key of (uuid, recurrence, email, owner emails) the ids
+        of the attendees with the email on the todos with the same uuid and
+        recurrence in the calendars owned by the owner emails
+        """
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Calendar = pool.get('calendar.calendar')
+        User = pool.get('res.user')
+        table = cls.__table__()
+        todo = Todo.__table__()
+        calendar = Calendar.__table__()
+        user = User.__table__()
+        cursor = Transaction().connection.cursor()
+
+        copies = dict((k, []) for k in keys)
+        attendees = {}
+        query_table = table.join(todo, condition=table.todo == todo.id
+            ).join(calendar, condition=todo.calendar == calendar.id
+            ).join(user, condition=calendar.owner == user.id)
+        for sub_uuids in grouped_slice(set(k[0] for k in keys)):
+            cursor.execute(*query_table.select(
+                    table.id, todo.uuid, todo.recurrence, table.email,
+                    user.email,
+                    where=todo.uuid.in_(list(sub_uuids))))
+            for (attendee_id, uuid_, recurrence, email,
+                    owner_email) in cursor.fetchall():
+                attendees.setdefault((uuid_, recurrence, email), []).append(
+                    (attendee_id, owner_email))
+        for key in keys:
+            uuid_, recurrence, email, emails = key
+            copies[key] = [i for i, e in attendees.get(
+                    (uuid_, recurrence, email), []) if e in emails]
+        return copies
+
     @classmethod
     def create(cls, vlist):
-        Todo = Pool().get('calendar.todo')
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Propagation = pool.get('calendar.todo.propagation')
 
         towrite = []
         for values in vlist:
@@ -1054,42 +1893,45 @@ class TodoAttendee(AttendeeMixin, ModelSQL, ModelView):
         if towrite:
             Todo.write(Todo.browse(towrite), {})
         attendees = super(TodoAttendee, cls).create(vlist)
+
+        if Propagation.deferred():
+            Propagation.enqueue_attendee_update(attendees)
+            return attendees
+
+        keys = {}
         for attendee in attendees:
             todo = attendee.todo
-            if (todo.calendar.owner
-                    and (todo.organizer == todo.calendar.owner.email
-                        or (todo.parent
-                            and todo.parent.organizer
-                            == todo.parent.calendar.owner.email))):
-                if todo.organizer == todo.calendar.owner.email:
-                    attendee_emails = [x.email for x in todo.attendees
-                            if x.email != todo.organizer]
-                else:
-                    attendee_emails = [x.email for x in todo.parent.attendees
-                            if x.email != todo.parent.organizer]
-                if attendee_emails:
-                    with Transaction().set_user(0):
-                        todos = Todo.search([
-                            ('uuid', '=', todo.uuid),
-                            ('calendar.owner.email', 'in', attendee_emails),
-                            ('id', '!=', todo.id),
-                            ('recurrence', '=', todo.recurrence),
-                            ])
-                        for todo in todos:
-                            cls.copy([attendee], default={
-                                'todo': todo.id,
-                                })
+            attendee_emails = Todo._attendee_emails(todo)
+            if attendee_emails:
+                keys[attendee] = (
+                    todo.uuid, todo.recurrence, tuple(attendee_emails))
+        if keys:
+            with Transaction().set_user(0):
+                copies = Todo._copies(keys.values())
+                to_create = []
+                for attendee, key in keys.iteritems():
+                    for todo_id in copies[key]:
+                        if todo_id == attendee.todo.id:
+                            continue
+                        values = attendee._attendee2update()
+                        values['email'] = attendee.email
+                        values['todo'] = todo_id
+                        to_create.append(values)
+                if to_create:
+                    cls.create(to_create)
         return attendees
 
     @classmethod
     def write(cls, *args):
-        Todo = Pool().get('calendar.todo')
+        pool = Pool()
+        Todo = pool.get('calendar.todo')
+        Propagation = pool.get('calendar.todo.propagation')
 
         actions = iter(args)
         args = []
         todos = []
         for todo_attendees, values in zip(actions, actions):
-            todos += [x.todo.id for x in todo_attendees]
+            todos += [x.todo for x in todo_attendees]
             if values.get('todo'):
                 todos.append(Todo(values['todo']))
             if 'email' in values:
@@ -1103,85 +1945,141 @@ class TodoAttendee(AttendeeMixin, ModelSQL, ModelView):
 
         super(TodoAttendee, cls).write(*args)
 
+        if Propagation.deferred():
+            Propagation.enqueue_attendee_update(sum(args[::2], []))
+            return
+
+        keys = {}
         for todo_attendee in sum(args[::2], []):
             todo = todo_attendee.todo
-            if (todo.calendar.owner
-                    and (todo.organizer == todo.calendar.owner.email
-                        or (todo.parent
-                            and todo.parent.organizer
-                            == todo.calendar.owner.email))):
-                if todo.organizer == todo.calendar.owner.email:
-                    attendee_emails = [x.email for x in todo.attendees
-                            if x.email != todo.organizer]
-                else:
-                    attendee_emails = [x.email for x in todo.parent.attendees
-                            if x.email != todo.parent.organizer]
-                if attendee_emails:
-                    with Transaction().set_user(0):
-                        attendees2 = cls.search([
-                                ('todo.uuid', '=', todo.uuid),
-                                ('todo.calendar.owner.email', 'in',
-                                    attendee_emails),
-                                ('id', '!=', todo_attendee.id),
-                                ('todo.recurrence', '=', todo.recurrence),
-                                ('email', '=', todo_attendee.email),
-                                ])
-                        cls.write(attendees2, todo_attendee._attendee2update())
+            attendee_emails = Todo._attendee_emails(todo)
+            if attendee_emails:
+                keys[todo_attendee] = (todo.uuid, todo.recurrence,
+                    todo_attendee.email, tuple(attendee_emails))
+        if keys:
+            ids = set(a.id for a in keys)
+            with Transaction().set_user(0):
+                copies = cls._copies(keys.values())
+                to_write = []
+                for todo_attendee, key in keys.iteritems():
+                    attendees2 = cls.browse(
+                        [i for i in copies[key] if i not in ids])
+                    if attendees2:
+                        to_write.extend(
+                            (attendees2, todo_attendee._attendee2update()))
+                if to_write:
+                    cls.write(*to_write)
+
+    @classmethod
+    def _propagate_update(cls, attendees):
+        '''
+        Update the attendees on the copies of their todo and create them on
+        the copies missing them
+        '''
+        Todo = Pool().get('calendar.todo')
+
+        todo_keys, keys = {}, {}
+        for attendee in attendees:
+            todo = attendee.todo
+            attendee_emails = Todo._attendee_emails(todo)
+            if attendee_emails:
+                todo_keys[attendee] = (
+                    todo.uuid, todo.recurrence, tuple(attendee_emails))
+                keys[attendee] = (todo.uuid, todo.recurrence,
+                    attendee.email, tuple(attendee_emails))
+        if not keys:
+            return
+        ids = set(a.id for a in keys)
+        with Transaction().set_user(0):
+            todo_copies = Todo._copies(todo_keys.values())
+            copies = cls._copies(keys.values())
+            to_write, to_create = [], []
+            for attendee, key in keys.iteritems():
+                attendees2 = cls.browse(
+                    [i for i in copies[key] if i not in ids])
+                if attendees2:
+                    to_write.extend((attendees2, attendee._attendee2update()))
+                todo_ids = set(a.todo.id for a in attendees2)
+                todo_ids.add(attendee.todo.id)
+                for todo_id in todo_copies[todo_keys[attendee]]:
+                    if todo_id in todo_ids:
+                        continue
+                    values = attendee._attendee2update()
+                    values['email'] = attendee.email
+                    values['todo'] = todo_id
+                    to_create.append(values)
+            if to_write:
+                cls.write(*to_write)
+            if to_create:
+                cls.create(to_create)
+
+    @classmethod
+    def _delete_keys(cls, attendee):
+        '''
+        Return the keys of the copies of the attendee to delete and to
+        decline for _copies
+        '''
+        Todo = Pool().get('calendar.todo')
+
+        todo = attendee.todo
+        attendee_emails = Todo._attendee_emails(todo)
+        if attendee_emails is not None:
+            if attendee_emails:
+                return [(todo.uuid, todo.recurrence, attendee.email,
+                        tuple(attendee_emails))], []
+        elif (todo.calendar.owner
+                and ((todo.organizer
+                        or (todo.parent and todo.parent.organizer))
+                    and attendee.email == todo.calendar.owner.email)):
+            if todo.organizer:
+                organizer = todo.organizer
+            else:
+                organizer = todo.parent.organizer
+            return [], [(todo.uuid, todo.recurrence, attendee.email,
+                    (organizer,))]
+        return [], []
+
+    @classmethod
+    def _propagate_delete(cls, delete_keys, decline_keys, ids=None):
+        '''
+        Delete and decline the copies of the keys except the ids
+        '''
+        ids = set(ids or [])
+        with Transaction().set_user(0):
+            copies = cls._copies(delete_keys + decline_keys)
+            to_delete = set(i for k in delete_keys for i in copies[k])
+            to_delete -= ids
+            to_decline = set(i for k in decline_keys for i in copies[k])
+            to_decline -= ids | to_delete
+            if to_delete:
+                cls.delete(cls.browse(list(to_delete)))
+            if to_decline:
+                cls.write(cls.browse(list(to_decline)), {
+                        'status': 'declined',
+                        })
 
     @classmethod
     def delete(cls, todo_attendees):
         pool = Pool()
         Todo = pool.get('calendar.todo')
+        Propagation = pool.get('calendar.todo.propagation')
 
         todos = [x.todo for x in todo_attendees]
         if todos:
             # Update write_date of todo
             Todo.write(todos, {})
 
-        for attendee in todo_attendees:
-            todo = attendee.todo
-            if (todo.calendar.owner
-                    and (todo.organizer == todo.calendar.owner.email
-                        or (todo.parent
-                            and todo.parent.organizer
-                            == todo.calendar.owner.email))):
-                if todo.organizer == todo.calendar.owner.email:
-                    attendee_emails = [x.email for x in todo.attendees
-                            if x.email != todo.organizer]
-                else:
-                    attendee_emails = [x.email for x in todo.attendees
-                            if x.email != todo.parent.organizer]
-                if attendee_emails:
-                    with Transaction().set_user(0):
-                        attendees = cls.search([
-                            ('todo.uuid', '=', todo.uuid),
-                            ('todo.calendar.owner.email', 'in',
-                                attendee_emails),
-                            ('id', '!=', attendee.id),
-                            ('todo.recurrence', '=', todo.recurrence),
-                            ('email', '=', attendee.email),
-                            ])
-                        cls.delete(attendees)
-            elif (todo.calendar.organizer
-                    and ((todo.organizer
-                            or (todo.parent and todo.parent.organizer))
-                        and attendee.email == todo.calendar.owner.email)):
-                if todo.organizer:
-                    organizer = todo.organizer
-                else:
-                    organizer = todo.parent.organizer
-                with Transaction().set_user(0):
-                    attendees = cls.search([
-                        ('todo.uuid', '=', todo.uuid),
-                        ('todo.calendar.owner.email', '=', organizer),
-                        ('id', '!=', attendee.id),
-                        ('todo.recurrence', '=', todo.recurrence),
-                        ('email', '=', attendee.email),
-                        ])
-                    if attendees:
-                        cls.write(attendees, {
-                            'status': 'declined',
-                            })
+        if Propagation.deferred():
+            Propagation.enqueue_attendee_delete(todo_attendees)
+        else:
+            delete_keys, decline_keys = [], []
+            for attendee in todo_attendees:
+                attendee_delete, attendee_decline = cls._delete_keys(attendee)
+                delete_keys.extend(attendee_delete)
+                decline_keys.extend(attendee_decline)
+            if delete_keys or decline_keys:
+                cls._propagate_delete(delete_keys, decline_keys,
+                    [a.id for a in todo_attendees])
         super(TodoAttendee, cls).delete(todo_attendees)
 
 
@@ -1246,3 +2144,100 @@ class TodoAlarm(AlarmMixin, ModelSQL, ModelView):
             # Update write_date of todo
             Todo.write(todos, {})
         super(TodoAlarm, cls).delete(todo_alarms)
+
+
+class TodoTombstone(ModelSQL):
+    'Todo Tombstone'
+    __name__ = 'calendar.todo.tombstone'
+    todo = fields.Integer('Todo', required=True)
+    uuid = fields.Char('UUID', required=True)
+    recurrence = fields.DateTime('Recurrence')
+    calendar = fields.Many2One('calendar.calendar', 'Calendar',
+        required=True, select=True, ondelete='CASCADE')
+    parent = fields.Integer('Parent')
+    # The fields of the todos recorded by the tombstones
+    _todo_fields = {
+        'id': 'todo',
+        'uuid': 'uuid',
+        'recurrence': 'recurrence',
+        'calendar': 'calendar',
+        'parent': 'parent',
+        }
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(TodoTombstone, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action('create_date', 'add')
+
+    @classmethod
+    def add(cls, ids):
+        'Record the deletion of the todos of the ids'
+        Todo = Pool().get('calendar.todo')
+        table = cls.__table__()
+        todo = Todo.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        now = datetime.datetime.now()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.insert(
+                    columns=[table.todo, table.uuid, table.recurrence,
+                        table.calendar, table.parent, table.create_uid,
+                        table.create_date],
+                    values=todo.select(todo.id, todo.uuid, todo.recurrence,
+                        todo.calendar, todo.parent, Literal(transaction.user),
+                        Literal(now),
+                        where=reduce_ids(todo.id, list(sub_ids)))))
+
+    @classmethod
+    def convert_domain(cls, domain):
+        '''
+        Convert the domain on the todos into a domain on the tombstones
+        matching at least the deleted todos of the domain. The clauses on
+        the fields not recorded are considered as true.
+        '''
+        def convert(domain):
+            # None stands for true
+            if not domain:
+                return None
+            if (isinstance(domain[0], basestring)
+                    and domain[0] not in ('AND', 'OR')):
+                name, operator = domain[:2]
+                name, dot, nested = name.partition('.')
+                if name not in cls._todo_fields:
+                    return None
+                field = cls._todo_fields[name]
+                if (isinstance(cls._fields[field], fields.Integer)
+                        and (nested
+                            or operator not in ('=', '!=', 'in', 'not in'))):
+                    return None
+                return (field + dot + nested,) + tuple(domain[1:])
+            if domain[0] == 'OR':
+                clauses = [convert(d) for d in domain[1:]]
+                if None in clauses:
+                    return None
+                return ['OR'] + clauses
+            if domain[0] == 'AND':
+                domain = domain[1:]
+            clauses = [c for c in (convert(d) for d in domain)
+                if c is not None]
+            return clauses or None
+        return convert(domain) or []
+
+    @classmethod
+    def clean(cls, age=None):
+        '''
+        Delete the tombstones older than age days. The default age is the
+        tombstone_age of the calendar_todo configuration section.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if age is None:
+            age = config.getint('calendar_todo', 'tombstone_age', default=90)
+        limit = datetime.datetime.now() - datetime.timedelta(days=age)
+        cursor.execute(*table.delete(where=table.create_date < limit))
@@ -0,0 +1,65 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.model import fields
+from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['User']
+__metaclass__ = PoolMeta
+
+
+class User:
+    __name__ = 'res.user'
+    todo_read_calendars = fields.Function(fields.One2Many(
+            'calendar.calendar', None, 'Todo Read Calendars'),
+        'get_todo_calendars')
+    todo_write_calendars = fields.Function(fields.One2Many(
+            'calendar.calendar', None, 'Todo Write Calendars'),
+        'get_todo_calendars')
+    _todo_calendars_cache = Cache('res_user.todo_calendars', context=False)
+
+    @classmethod
+    def get_todo_calendars(cls, users, names):
+        result = {}
+        for name in names:
+            mode = name[len('todo_'):-len('_calendars')]
+            result[name] = dict((u.id, cls._todo_calendars(u.id, mode))
+                for u in users)
+        return result
+
+    @classmethod
+    def _todo_calendars(cls, user_id, mode):
+        '''
+        Return the ids of the calendars owned by the user or shared with the
+        user for the mode (read or write)
+        '''
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        Share = pool.get('calendar.calendar-%s-res.user' % mode)
+        calendar = Calendar.__table__()
+        share = Share.__table__()
+        cursor = Transaction().connection.cursor()
+
+        key = (user_id, mode)
+        calendar_ids = cls._todo_calendars_cache.get(key)
+        if calendar_ids is not None:
+            return list(calendar_ids)
+        cursor.execute(*(calendar.select(calendar.id,
+                    where=calendar.owner == user_id)
+                | share.select(share.calendar,
+                    where=share.user == user_id)))
+        calendar_ids = sorted(set(c for c, in cursor.fetchall()))
+        cls._todo_calendars_cache.set(key, calendar_ids)
+        return list(calendar_ids)
+
+    @classmethod
+    def _todo_calendars_clear(cls):
+        'Clear the caches of the calendars, the record rules and the todos'
+        pool = Pool()
+        Rule = pool.get('ir.rule')
+        Collection = pool.get('webdav.collection')
+        cls._todo_calendars_cache.clear()
+        Rule._domain_get_cache.clear()
+        # The todo ids are cached per user as they depend on the rules
+        Collection._todo_cache_clear()
@@ -1,26 +1,57 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import uuid
 import vobject
 import urllib
+from itertools import chain
 from pywebdav.lib.errors import DAV_NotFound, DAV_Forbidden
 from sql.functions import Extract
 from sql.conditionals import Coalesce
 from sql.aggregate import Max
 
+from trytond import backend
 from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 from trytond.cache import Cache
 from trytond.pool import Pool, PoolMeta
 
+from .instrument import measure, measured, hit, miss
+
 __all__ = ['Collection']
 __metaclass__ = PoolMeta
 
+TODO_CACHES = 16
+
 
 class Collection:
     __name__ = "webdav.collection"
-    _todo_cache = Cache('webdav_collection.todo')
+    # The todo lookups are spread over a fixed number of caches by calendar
+    _todo_caches = tuple(Cache('webdav_collection.todo.%s' % i, context=False)
+        for i in range(TODO_CACHES))
 
     @classmethod
+    def _todo_cache(cls, calendar_id):
+        '''
+        Return the cache of the todo ids per calendar, user and uuid of the
+        calendar
+        '''
+        return cls._todo_caches[calendar_id % len(cls._todo_caches)]
+
+    @classmethod
+    def _todo_cache_clear(cls, calendar_ids=None):
+        '''
+        Clear the cache of the todo ids of the calendars or of all
+        '''
+        if calendar_ids is None:
+            caches = cls._todo_caches
+        else:
+            caches = set(cls._todo_cache(c) for c in calendar_ids)
+        for cache in caches:
+            cache.clear()
+
+    @classmethod
+    @measured('webdav.todo')
     def todo(cls, uri, calendar_id=False):
         '''
         Return the todo id in the uri
@@ -33,12 +64,24 @@ class Collection:
                 calendar_id = cls.calendar(uri)
                 if not calendar_id:
                     return None
-            todos = Todo.search([
-                ('calendar', '=', calendar_id),
-                ('uuid', '=', todo_uri[:-4]),
-                ('parent', '=', None),
-                ], limit=1)
+            cache = cls._todo_cache(calendar_id)
+            # The key contains the user because of the record rules
+            key = (calendar_id, Transaction().user, todo_uri[:-4])
+            todo_id = cache.get(key)
+            if todo_id is not None:
+                hit('webdav.todo')
+                return todo_id
+            miss('webdav.todo')
+            # Archived todos are not listed but can still be read
+            with Transaction().set_context(active_test=False):
+                todos = Todo.search([
+                    ('calendar', '=', calendar_id),
+                    ('uuid', '=', todo_uri[:-4]),
+                    ('parent', '=', None),
+                    ], limit=1)
             if todos:
+                # Only found todos are cached as creation does not clear
+                cache.set(key, todos[0].id)
                 return todos[0].id
 
     @classmethod
@@ -104,8 +147,21 @@ class Collection:
         return res
 
     @classmethod
+    @measured('webdav.get_childs')
     def get_childs(cls, uri, filter=None, cache=None):
+        return list(cls.iter_childs(uri, filter=filter, cache=cache,
+                evict=False))
+
+    @classmethod
+    def iter_childs(cls, uri, filter=None, cache=None, evict=True):
+        '''
+        Return an iterable of the childs of the uri like get_childs but with
+        the hrefs of the todos of a calendar fetched lazily. If evict is
+        set, the todos are removed from the cache by batches once their
+        hrefs are consumed.
+        '''
         Todo = Pool().get('calendar.todo')
+        todo = Todo.__table__()
 
         res = super(Collection, cls).get_childs(uri, filter=filter,
                 cache=cache)
@@ -115,19 +171,76 @@ class Collection:
             calendar_id = cls.calendar(uri)
             if calendar_id and not (uri[10:].split('/', 1) + [None])[1]:
                 domain = cls._caldav_filter_domain_todo(filter)
-                todos = Todo.search([
-                    ('calendar', '=', calendar_id),
-                    domain,
-                    ])
-                if cache is not None:
-                    cache.setdefault('_calendar', {})
-                    cache['_calendar'].setdefault(Todo.__name__, {})
-                    for todo in todos:
-                        cache['_calendar'][Todo.__name__][todo.id] = {}
-                return res + [x.uuid + '.ics' for x in todos]
+                multiget = (filter is not None
+                    and filter.localName == 'calendar-multiget')
+                # The archived todos requested by href can still be read
+                with Transaction().set_context(active_test=not multiget):
+                    query = Todo.search([
+                            ('calendar', '=', calendar_id),
+                            domain,
+                            ], order=[], query=True)
+                if multiget:
+                    # The multiget is bounded by its hrefs
+                    cursor = Transaction().connection.cursor()
+                    cursor.execute(*todo.select(todo.id, todo.uuid,
+                            where=todo.id.in_(query),
+                            order_by=todo.id))
+                    todos = cursor.fetchall()
+                    if cache is not None:
+                        cache.setdefault('_calendar', {})
+                        cache['_calendar'].setdefault(Todo.__name__, {})
+                        for todo_id, _ in todos:
+                            cache['_calendar'][Todo.__name__][todo_id] = {}
+                        cache['_calendar_todo_multiget'] = (
+                            cls._multiget_data([i for i, _ in todos]))
+                        cache['_calendar_todo_data'] = {}
+                    return res + [u + '.ics' for _, u in todos]
+                return chain(res, cls._todo_childs(query, cache=cache,
+                        evict=evict))
 
         return res
 
+    @classmethod
+    def _todo_childs(cls, query, cache=None, evict=False):
+        '''
+        Yield the hrefs of the todos of the query from a cursor on their id
+        and uuid. The rows are fetched by batches and the ids of each batch
+        are added to the cache before yielding their hrefs. If evict is set,
+        the ids of a batch and their properties are removed from the cache
+        before fetching the next one so the cache stays bounded by the
+        size of a batch.
+        '''
+        Todo = Pool().get('calendar.todo')
+        todo = Todo.__table__()
+        transaction = Transaction()
+
+        if backend.name() == 'postgresql':
+            cursor = transaction.connection.cursor(
+                'webdav_collection_todo_%s' % uuid.uuid4().hex)
+        else:
+            cursor = transaction.connection.cursor()
+        cursor.execute(*todo.select(todo.id, todo.uuid,
+                where=todo.id.in_(query),
+                order_by=todo.id))
+        if cache is not None:
+            cache.setdefault('_calendar', {})
+            todos_cache = cache['_calendar'].setdefault(Todo.__name__, {})
+        try:
+            while True:
+                rows = cursor.fetchmany(transaction.database.IN_MAX)
+                if not rows:
+                    break
+                if cache is not None:
+                    for todo_id, _ in rows:
+                        todos_cache.setdefault(todo_id, {})
+                for _, uuid_ in rows:
+                    yield uuid_ + '.ics'
+                if cache is not None and evict:
+                    for todo_id, _ in rows:
+                        todos_cache.pop(todo_id, None)
+        finally:
+            cursor.close()
+
     @classmethod
     def get_resourcetype(cls, uri, cache=None):
         from pywebdav.lib.constants import COLLECTION, OBJECT
@@ -151,6 +264,7 @@ class Collection:
         return super(Collection, cls).get_contenttype(uri, cache=cache)
 
     @classmethod
+    @measured('webdav.get_creationdate')
     def get_creationdate(cls, uri, cache=None):
         Todo = Pool().get('calendar.todo')
         todo = Todo.__table__()
@@ -167,13 +281,16 @@ class Collection:
                 if cache is not None:
                     cache.setdefault('_calendar', {})
                     cache['_calendar'].setdefault(Todo.__name__, {})
-                    ids = cache['_calendar'][Todo.__name__].keys()
-                    if todo_id not in ids:
+                    todos_cache = cache['_calendar'][Todo.__name__]
+                    if 'creationdate' in todos_cache.get(todo_id, {}):
+                        hit('webdav.creationdate')
+                        return todos_cache[todo_id]['creationdate']
+                    miss('webdav.creationdate')
+                    # Load only the todos missing it
+                    ids = [i for i, v in todos_cache.iteritems()
+                        if 'creationdate' not in v]
+                    if todo_id not in todos_cache:
                         ids.append(todo_id)
-                    elif 'creationdate' in cache['_calendar'][
-                            Todo.__name__][todo_id]:
-                        return cache['_calendar'][Todo.__name__][
-                            todo_id]['creationdate']
                 else:
                     ids = [todo_id]
                 res = None
@@ -196,6 +313,7 @@ class Collection:
         return super(Collection, cls).get_creationdate(uri, cache=cache)
 
     @classmethod
+    @measured('webdav.get_lastmodified')
     def get_lastmodified(cls, uri, cache=None):
         Todo = Pool().get('calendar.todo')
         todo = Todo.__table__()
@@ -210,13 +328,16 @@ class Collection:
                 if cache is not None:
                     cache.setdefault('_calendar', {})
                     cache['_calendar'].setdefault(Todo.__name__, {})
-                    ids = cache['_calendar'][Todo.__name__].keys()
-                    if todo_id not in ids:
+                    todos_cache = cache['_calendar'][Todo.__name__]
+                    if 'lastmodified' in todos_cache.get(todo_id, {}):
+                        hit('webdav.lastmodified')
+                        return todos_cache[todo_id]['lastmodified']
+                    miss('webdav.lastmodified')
+                    # Load only the todos missing it
+                    ids = [i for i, v in todos_cache.iteritems()
+                        if 'lastmodified' not in v]
+                    if todo_id not in todos_cache:
                         ids.append(todo_id)
-                    elif 'lastmodified' in cache['_calendar'][
-                            Todo.__name__][todo_id]:
-                        return cache['_calendar'][Todo.__name__][
-                            todo_id]['lastmodified']
                 else:
                     ids = [todo_id]
                 res = None
@@ -243,6 +364,56 @@ class Collection:
         return super(Collection, cls).get_lastmodified(uri, cache=cache)
 
     @classmethod
+    @measured('webdav.get_etag')
+    def get_etag(cls, uri, cache=None):
+        '''
+        Return the entity tag of the todo in the uri or None
+        '''
+        Todo = Pool().get('calendar.todo')
+        todo = Todo.__table__()
+
+        cursor = Transaction().connection.cursor()
+
+        calendar_id = cls.calendar(uri)
+        if calendar_id and (uri[10:].split('/', 1) + [None])[1]:
+            todo_id = cls.todo(uri, calendar_id=calendar_id)
+            if not todo_id:
+                return
+            sequence = None
+            if cache is not None:
+                cache.setdefault('_calendar', {})
+                cache['_calendar'].setdefault(Todo.__name__, {})
+                todos_cache = cache['_calendar'][Todo.__name__]
+                if 'sequence' in todos_cache.get(todo_id, {}):
+                    hit('webdav.sequence')
+                    sequence = todos_cache[todo_id]['sequence']
+                    ids = []
+                else:
+                    miss('webdav.sequence')
+                    ids = [i for i, v in todos_cache.iteritems()
+                        if 'sequence' not in v]
+                    if todo_id not in todos_cache:
+                        ids.append(todo_id)
+            else:
+                ids = [todo_id]
+            if sequence is None:
+                for sub_ids in grouped_slice(ids):
+                    red_sql = reduce_ids(todo.id, sub_ids)
+                    cursor.execute(*todo.select(todo.id, todo.sequence,
+                            where=red_sql))
+                    for todo_id2, sequence2 in cursor.fetchall():
+                        if todo_id2 == todo_id:
+                            sequence = sequence2
+                        if cache is not None:
+                            cache['_calendar'][Todo.__name__]\
+                                .setdefault(todo_id2, {})
+                            cache['_calendar'][Todo.__name__][
+                                todo_id2]['sequence'] = sequence2
+            lastmodified = cls.get_lastmodified(uri, cache=cache)
+            return '"%s-%s-%.6f"' % (todo_id, sequence or 0, lastmodified)
+
+    @classmethod
+    @measured('webdav.get_data')
     def get_data(cls, uri, cache=None):
         Todo = Pool().get('calendar.todo')
 
@@ -253,12 +424,43 @@ class Collection:
             todo_id = cls.todo(uri, calendar_id=calendar_id)
             if not todo_id:
                 return super(Collection, cls).get_data(uri, cache=cache)
-            ical = Todo(todo_id).todo2ical()
-            return ical.serialize()
+            if cache is not None and '_calendar_todo_multiget' in cache:
+                datas = cache['_calendar_todo_data']
+                if todo_id not in datas:
+                    for todo_id2, data in cache['_calendar_todo_multiget']:
+                        datas[todo_id2] = data
+                        if todo_id2 == todo_id:
+                            break
+                if todo_id in datas:
+                    return datas.pop(todo_id)
+            with Transaction().set_context(active_test=False):
+                ical = Todo(todo_id).todo2ical()
+            with measure('ical.serialize'):
+                return ical.serialize()
 
         return super(Collection, cls).get_data(uri, cache=cache)
 
     @classmethod
+    def _multiget_data(cls, todo_ids):
+        '''
+        Yield the id and the iCalendar data of the todos in the order of the
+        ids. The todos are read by slices to load their relations in bulk
+        and each one is serialized only when it is requested. The archived
+        occurences are included like in get_data.
+        '''
+        Todo = Pool().get('calendar.todo')
+        for sub_ids in grouped_slice(todo_ids):
+            with Transaction().set_context(active_test=False):
+                todos = Todo.browse(list(sub_ids))
+            for todo in todos:
+                with Transaction().set_context(active_test=False):
+                    ical = todo.todo2ical()
+                with measure('ical.serialize'):
+                    data = ical.serialize()
+                yield todo.id, data
+
+    @classmethod
+    @measured('webdav.put')
     def put(cls, uri, data, content_type, cache=None):
         pool = Pool()
         Todo = pool.get('calendar.todo')
@@ -269,25 +471,41 @@ class Collection:
             if not (uri[10:].split('/', 1) + [None])[1]:
                 raise DAV_Forbidden
             todo_id = cls.todo(uri, calendar_id=calendar_id)
-            ical = vobject.readOne(data)
+            with measure('ical.parse'):
+                ical = vobject.readOne(data)
             if not hasattr(ical, 'vtodo'):
                 return super(Collection, cls).put(uri, data, content_type)
 
+            plain = Todo.ical2plain(ical)
+            ical_hash = Todo._plain_hash(plain)
             if not todo_id:
 
-                values = Todo.ical2values(None, ical, calendar_id)
+                values = Todo.plain2values(None, plain, calendar_id)
                 todo, = Todo.create([values])
+                Todo.set_ical_hash(todo.id, ical_hash)
                 calendar = Calendar(calendar_id)
                 return Transaction().database.name + '/Calendars/' + \
                     calendar.name + '/' + todo.uuid + '.ics'
             else:
-                values = Todo.ical2values(todo_id, ical, calendar_id)
-                Todo.write([Todo(todo_id)], values)
+                # Skip the iCalendar already put and unchanged since but
+                # only for who may write it
+                try:
+                    Todo._check_write([todo_id])
+                except UserError:
+                    raise DAV_Forbidden
+                todo = Todo(todo_id)
+                if todo.ical_hash == ical_hash:
+                    return
+                values = Todo.plain2values(todo_id, plain, calendar_id)
+                if values:
+                    Todo.write([todo], values)
+                Todo.set_ical_hash(todo_id, ical_hash)
                 return
 
         return super(Collection, cls).put(uri, data, content_type)
 
     @classmethod
+    @measured('webdav.rm')
     def rm(cls, uri, cache=None):
         Todo = Pool().get('calendar.todo')
 